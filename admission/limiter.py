@@ -0,0 +1,124 @@
+import asyncio
+import math
+import time
+from collections import deque
+
+from fastapi import HTTPException, status
+
+from metrics.registry import Counter, Gauge, registry
+from settings import ADMISSION_LIMITS, HASH_WORKERS
+
+# a burst on one group of routes (bcrypt on /token, sync db sessions on the crud routes) used to take every
+# threadpool thread, after which even cheap routes timed out. each group now has a concurrency limit and a
+# bounded queue, waiting happens on the event loop rather than on a thread, and a request that can't be
+# served in time is turned away straight away.
+
+# group: (limit, queue, max wait ms)
+DEFAULT_LIMITS = {
+    # the hashing pool is the bottleneck, let a couple of logins per worker queue on it
+    'auth': (max(HASH_WORKERS, 1) * 2, 64, 2000),
+    'db': (32, 128, 2000),
+}
+
+admitted = registry.add(Counter('admission_admitted_total', 'Requests admitted by group.', ('group',)))
+rejected = registry.add(Counter('admission_rejected_total', 'Requests turned away with a 503 by group.', ('group',)))
+in_use = registry.add(Gauge('admission_in_use', 'Requests running by group.', ('group',)))
+waiting = registry.add(Gauge('admission_waiting', 'Requests queued by group.', ('group',)))
+
+
+class Limiter:
+    def __init__(self, name: str, limit: int, queue_size: int, max_wait_ms: float):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.max_wait = max_wait_ms / 1000
+        self.active = 0
+        self.waiters = deque()
+        # moving average of how long an admitted request holds its slot
+        self.service_time = 0.0
+
+    def estimated_wait(self, position: int):
+        # the slots free up at about limit / service_time a second
+        return (position + 1) * self.service_time / self.limit
+
+    def reject(self, wait: float):
+        rejected.inc((self.name,))
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Too busy to serve {self.name} requests, try again later",
+            headers={'Retry-After': str(max(1, math.ceil(wait)))}
+        )
+
+    async def acquire(self):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            admitted.inc((self.name,))
+            return
+        wait = self.estimated_wait(len(self.waiters))
+        # no point queueing a request that would still be waiting when its time is up
+        if len(self.waiters) >= self.queue_size or wait > self.max_wait:
+            self.reject(wait)
+        slot = asyncio.get_running_loop().create_future()
+        self.waiters.append(slot)
+        try:
+            await asyncio.wait_for(asyncio.shield(slot), self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as error:
+            if slot.done():
+                # handed a slot just as the wait ended, pass it on
+                self.release()
+            else:
+                self.waiters.remove(slot)
+            if isinstance(error, asyncio.CancelledError):
+                raise
+            self.reject(self.estimated_wait(len(self.waiters)))
+        admitted.inc((self.name,))
+
+    def release(self, held: float = None):
+        if held is not None:
+            self.service_time = held if not self.service_time else 0.8 * self.service_time + 0.2 * held
+        # the slot goes straight to the next waiter, so active doesn't change
+        while self.waiters:
+            slot = self.waiters.popleft()
+            if not slot.done():
+                slot.set_result(None)
+                return
+        self.active -= 1
+
+
+def parse_limits(value: str):
+    limits = dict(DEFAULT_LIMITS)
+    for entry in filter(None, (part.strip() for part in value.split(','))):
+        name, _, numbers = entry.partition('=')
+        limit, queue_size, max_wait_ms = numbers.split(':')
+        limits[name.strip()] = (int(limit), int(queue_size), float(max_wait_ms))
+    return limits
+
+
+limiters = {name: Limiter(name, *options) for name, options in parse_limits(ADMISSION_LIMITS).items()}
+
+
+def admission(group: str):
+    """router dependency, holds one of the group's slots for the whole request."""
+    limiter = limiters[group]
+
+    async def admit():
+        if not limiter.limit:
+            yield
+            return
+        await limiter.acquire()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            limiter.release(time.perf_counter() - start)
+
+    return admit
+
+
+def collect_admission():
+    for name, limiter in limiters.items():
+        in_use.set((name,), limiter.active)
+        waiting.set((name,), len(limiter.waiters))
+
+
+registry.collectors.append(collect_admission)
@@ -1,31 +1,40 @@
 from fastapi import APIRouter, HTTPException, status
+from admission.limiter import admission
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
 from fastapi.param_functions import Depends
+from starlette.concurrency import run_in_threadpool
 from db.database import get_db
 from sqlalchemy.orm.session import Session
-from db import models
+from db import models, db_token
 from db.hash import Hash
 from auth import outh2
 
 router = APIRouter(
-    tags=['authentication']
+    tags=['authentication'],
+    dependencies=[Depends(admission('auth'))]
 )
 
 # token here needs to be the same as the OAuth2PasswordBearer(tokenUrl="token")
+# async so the bcrypt verify (in the hashing process pool) doesn't hold a threadpool worker, the queries still run in one.
 @router.post('/token')
-def get_token(request: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def get_token(request: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
 
-    user = db.query(models.DbUser).filter(models.DbUser.username == request.username).first()
+    user = await run_in_threadpool(
+        lambda: db.query(models.DbUser).filter(models.DbUser.username == request.username).first()
+    )
 
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='invalid credentials')
-    if not Hash.verify(user.password, request.password):
+    if not await Hash.verify_async(user.password, request.password):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='incorrect password')
+    # read before any commit, expired attributes would reload on the event loop
+    user_id, username = user.id, user.username
+    # the password is known to be right, so upgrade a hash made with an older, lower cost
+    if Hash.needs_update(user.password):
+        user.password = await Hash.bcrypt_async(request.password)
+        await run_in_threadpool(db.commit)
 
-    access_token, expire = outh2.create_access_token(data={"sub": user.username})
+    # long lived, exchanged at /token/refresh for new access tokens without another bcrypt verify
+    refresh_token, refresh_expires = await run_in_threadpool(db_token.create_refresh_token, db, user_id)
 
-    return {'access_token': access_token,
-            'token_expires': expire,
-            'token_type': 'bearer',
-            'user_id': user.id,
-            'user_name': user.username}
+    return outh2.token_response(user_id, username, refresh_token, refresh_expires)
@@ -0,0 +1,36 @@
+from fastapi import APIRouter, HTTPException, status
+from admission.limiter import admission
+from fastapi.security.oauth2 import OAuth2PasswordRequestForm
+from fastapi.param_functions import Depends
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.database import get_async_db
+from db import models, db_token
+from db.hash import Hash
+from auth import outh2
+
+# async version of authentication.py, used when DB_ASYNC is set.
+router = APIRouter(
+    tags=['authentication'],
+    dependencies=[Depends(admission('auth'))]
+)
+
+@router.post('/token')
+async def get_token(request: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+
+    result = await db.execute(select(models.DbUser).filter(models.DbUser.username == request.username))
+    user = result.scalars().first()
+
+    if not user:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='invalid credentials')
+    if not await Hash.verify_async(user.password, request.password):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='incorrect password')
+    # the password is known to be right, so upgrade a hash made with an older, lower cost
+    if Hash.needs_update(user.password):
+        user.password = await Hash.bcrypt_async(request.password)
+        await db.commit()
+
+    # long lived, exchanged at /token/refresh for new access tokens without another bcrypt verify
+    refresh_token, refresh_expires = await db.run_sync(db_token.create_refresh_token, user.id)
+
+    return outh2.token_response(user.id, user.username, refresh_token, refresh_expires)
@@ -4,10 +4,14 @@ from datetime import datetime, timedelta
 from jose import jwt
 from jose.exceptions import JWTError
 from dotenv import load_dotenv
+import time
 from fastapi import Depends, HTTPException, status
 from sqlalchemy.orm import Session
-from db.database import get_db
-from db import db_user
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.database import get_read_db
+from db import db_user, db_user_async
+from db.cache import make_cache, principal_cache
+from schemas import User
 import os
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
@@ -17,6 +21,10 @@ SECRET_KEY = os.getenv("OAUTH_SECRET_KEY")
 ALGORITHM = os.getenv("OAUTH_ALGO")
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# token -> (username, exp) for tokens whose signature and claims have already been checked,
+# so a client repeating the same bearer token skips the hmac. entries never outlive the token's exp.
+token_cache = make_cache('token')
+
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -29,12 +37,36 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt, expire
 
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
+def token_response(user_id: int, username: str, refresh_token: str, refresh_expires: datetime):
+    access_token, expire = create_access_token(data={"sub": username})
+    return {'access_token': access_token,
+            'token_expires': expire,
+            'refresh_token': refresh_token,
+            'refresh_token_expires': refresh_expires,
+            'token_type': 'bearer',
+            'user_id': user_id,
+            'user_name': username}
+
+
+def credentials_error():
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Couldn't validate credentials",
         headers={"WWW-Authenticate": "Bearer"}
     )
+
+
+def get_username(token: str):
+    """decode the token and return the username (sub) it was issued for."""
+    found, verified = token_cache.get(token)
+    if found:
+        username, expires = verified
+        if expires > time.time():
+            return username
+        token_cache.invalidate(token)
+        raise credentials_error()
+
+    credentials_exception = credentials_error()
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=ALGORITHM)
         username: str = payload.get("sub")
@@ -42,11 +74,22 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
             raise credentials_exception
     except JWTError:
         raise credentials_exception
+    token_cache.set(token, (username, payload["exp"]))
+    return username
 
-    user = db_user.get_user_by_username(db, username)
 
-    if user is None:
-        raise credentials_exception
+# the principal is cached as a User (id, username) for a few seconds, see principal_cache
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_read_db)):
+    username = get_username(token)
+    return principal_cache.get_or_load(
+        username, lambda: User.from_orm(db_user.get_user_by_username(db, username))
+    )
+
 
-    return user
+# no session of its own, a miss is loaded on one of principal_cache's
+async def get_current_user_async(token: str = Depends(oauth2_scheme)):
+    username = get_username(token)
 
+    async def load(db: AsyncSession):
+        return User.from_orm(await db_user_async.get_user_by_username(db, username))
+    return await principal_cache.aget_or_load(username, load)
@@ -0,0 +1,25 @@
+from fastapi import APIRouter
+from admission.limiter import admission
+from fastapi.param_functions import Depends
+from sqlalchemy.orm.session import Session
+from db.database import get_db
+from db import db_token
+from schemas import RefreshRequest
+from auth import outh2
+
+# refresh tokens are issued by /token, they're plain db lookups so these stay sync in both DB_ASYNC modes.
+router = APIRouter(
+    tags=['authentication'],
+    dependencies=[Depends(admission('auth'))]
+)
+
+# new access token (and a new refresh token, the old one stops working) without touching the password hash
+@router.post('/token/refresh')
+def refresh_token(request: RefreshRequest, db: Session = Depends(get_db)):
+    user, refresh_token, refresh_expires = db_token.rotate_refresh_token(db, request.refresh_token)
+    return outh2.token_response(user.id, user.username, refresh_token, refresh_expires)
+
+# sign out, the refresh token can't be used again
+@router.post('/token/revoke')
+def revoke_token(request: RefreshRequest, db: Session = Depends(get_db)):
+    return db_token.revoke_refresh_token(db, request.refresh_token)
@@ -0,0 +1,101 @@
+"""
+Compares the sync (threadpool) and async (aiosqlite) db paths under concurrent load.
+
+    python benchmarks/bench_async_db.py --requests 2000 --concurrency 200 --threads 8
+
+Each mode runs in its own process against a throw away copy of fastapi-practice.db.
+--threads shrinks starlette's threadpool to show what happens once it saturates.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def run_load(args):
+    import anyio.to_thread
+    import httpx
+    from db.schema import init_db
+    from main import app
+
+    # the client doesn't run the app's startup hooks, which is where the schema is set up
+    init_db()
+    anyio.to_thread.current_default_thread_limiter().total_tokens = args.threads
+
+    async with httpx.AsyncClient(app=app, base_url='http://bench') as client:
+        await client.post('/user/', json={'username': 'bench', 'email': 'bench@bench.com', 'password': 'bench'})
+        token = (await client.post('/token', data={'username': 'bench', 'password': 'bench'})).json()
+        headers = {'Authorization': 'Bearer ' + token['access_token']}
+        url = f"/user/{token['user_id']}"
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies = []
+
+        async def one():
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.get(url, headers=headers)
+                latencies.append(time.perf_counter() - start)
+                assert response.status_code == 200, response.text
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(args.requests)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        'req_per_s': args.requests / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--mode', choices=['sync', 'async'])
+    args = parser.parse_args()
+
+    if args.mode:
+        sys.path.insert(0, PROJECT_DIR)
+        os.chdir(PROJECT_DIR)
+        print(json.dumps(asyncio.run(run_load(args))))
+        return
+
+    print(f"{'mode':<6} {'req/s':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    for mode in ('sync', 'async'):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'bench.db')
+            shutil.copy(os.path.join(PROJECT_DIR, 'fastapi-practice.db'), db_path)
+            env = dict(os.environ,
+                       DATABASE_PATH=db_path,
+                       DB_ASYNC='true' if mode == 'async' else 'false')
+            env.setdefault('OAUTH_SECRET_KEY', 'bench')
+            env.setdefault('OAUTH_ALGO', 'HS256')
+            out = subprocess.run(
+                [sys.executable, __file__, '--mode', mode,
+                 '--requests', str(args.requests),
+                 '--concurrency', str(args.concurrency),
+                 '--threads', str(args.threads)],
+                env=env, check=True, capture_output=True, text=True
+            ).stdout
+            result = json.loads(out.strip().splitlines()[-1])
+            print(f"{mode:<6} {result['req_per_s']:>10.1f} {result['p50_ms']:>10.1f} {result['p99_ms']:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Creating users one POST /user/ at a time vs a single POST /user/bulk.
+
+    python benchmarks/bench_bulk_users.py --users 1000 --concurrency 16 --rounds 4
+
+Runs the app in process against a throw away copy of fastapi-practice.db. --rounds pins the bcrypt cost:
+at the production cost (~250ms a hash) both paths are bound by hashing, and bulk is only as much faster as
+there are HASH_WORKERS to hash on, at a low one what's left is the per request and per commit overhead.
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def users(prefix, count):
+    return [{'username': f'{prefix}{n}', 'email': f'{prefix}{n}@bench.com', 'password': 'bench'} for n in range(count)]
+
+
+async def run(args):
+    import httpx
+    from db.hash import Hash
+    from db.schema import init_db
+    from main import app
+
+    init_db()
+    Hash.calibrate()
+    try:
+        async with httpx.AsyncClient(app=app, base_url='http://bench', timeout=None) as client:
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def one(user):
+                async with semaphore:
+                    response = await client.post('/user/', json=user)
+                    assert response.status_code == 200, response.text
+
+            start = time.perf_counter()
+            await asyncio.gather(*(one(user) for user in users('single', args.users)))
+            single = time.perf_counter() - start
+
+            # /user/bulk needs a login, single0 was just created
+            token = (await client.post('/token', data={'username': 'single0', 'password': 'bench'})).json()
+            headers = {'Authorization': 'Bearer ' + token['access_token']}
+            start = time.perf_counter()
+            response = await client.post('/user/bulk', json=users('bulk', args.users), headers=headers)
+            bulk = time.perf_counter() - start
+            assert response.json()['created'] == args.users, response.text
+    finally:
+        Hash.shutdown()
+
+    print(f"{'path':>8} {'users/s':>10}")
+    print(f"{'single':>8} {args.users / single:>10.1f}")
+    print(f"{'bulk':>8} {args.users / bulk:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--rounds', type=int, default=4, help='bcrypt cost, 0 calibrates it like the app does')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'bench.db')
+        shutil.copy(os.path.join(PROJECT_DIR, 'fastapi-practice.db'), db_path)
+        # read by settings.py, so before anything from the app is imported
+        os.environ['DATABASE_PATH'] = db_path
+        os.environ['BCRYPT_ROUNDS'] = str(args.rounds)
+        os.environ.setdefault('OAUTH_SECRET_KEY', 'bench')
+        os.environ.setdefault('OAUTH_ALGO', 'HS256')
+        sys.path.insert(0, PROJECT_DIR)
+        os.chdir(PROJECT_DIR)
+        asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
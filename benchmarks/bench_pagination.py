@@ -0,0 +1,67 @@
+"""
+Keyset vs OFFSET pagination over a large users table.
+
+    python benchmarks/bench_pagination.py --rows 1000000
+
+Builds a throw away sqlite database with --rows users, then times fetching one page
+at increasing depths with both strategies. Keyset latency stays flat, OFFSET grows with depth.
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+
+from db.models import Base, DbUser
+from db.pagination import encode_cursor, keyset
+
+
+def build(path, rows):
+    Base.metadata.create_all(create_engine('sqlite:///' + path))
+    connection = sqlite3.connect(path)
+    connection.executemany(
+        'INSERT INTO users (id, username, email, password) VALUES (?, ?, ?, ?)',
+        ((i, f'user{i}', f'user{i}@example.com', 'x') for i in range(1, rows + 1))
+    )
+    connection.commit()
+    connection.close()
+
+
+def timed(db, statement, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        db.execute(statement).scalars().all()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'pagination.db')
+        build(path, args.rows)
+        db = Session(create_engine('sqlite:///' + path))
+
+        print(f"{'depth':>10} {'keyset ms':>10} {'offset ms':>10}")
+        depth = 1
+        while depth < args.rows:
+            keyset_ms = timed(db, keyset(select(DbUser), DbUser.id, args.limit, encode_cursor(depth)), args.repeat)
+            offset_ms = timed(db, select(DbUser).order_by(DbUser.id).offset(depth).limit(args.limit + 1), args.repeat)
+            print(f"{depth:>10} {keyset_ms:>10.3f} {offset_ms:>10.3f}")
+            depth *= 10
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
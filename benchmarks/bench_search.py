@@ -0,0 +1,74 @@
+"""
+FTS5 search vs a naive LIKE '%term%' scan over articles.
+
+    python benchmarks/bench_search.py --rows 200000
+
+Builds a throw away sqlite database with --rows generated articles, indexes it the
+same way the app does (db.search.create_search_index) and times both queries.
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+
+from db.models import Base
+from db.search import create_search_index, search_articles
+
+WORDS = ('alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo lima mike november oscar papa '
+         'quebec romeo sierra tango uniform victor whiskey xray yankee zulu').split()
+
+
+def build(path, rows):
+    engine = create_engine('sqlite:///' + path)
+    Base.metadata.create_all(engine)
+    connection = sqlite3.connect(path)
+    connection.execute("INSERT INTO users (id, username, email, password) VALUES (1, 'bench', 'b@b.com', 'x')")
+    random.seed(0)
+    connection.executemany(
+        'INSERT INTO articles (title, content, published, user_id) VALUES (?, ?, 1, 1)',
+        ((' '.join(random.choices(WORDS, k=4)), ' '.join(random.choices(WORDS, k=200))) for _ in range(rows))
+    )
+    # the needle the searches look for, in roughly one article in a thousand
+    connection.execute("UPDATE articles SET content = content || ' needle' WHERE id % 1000 = 0")
+    connection.commit()
+    connection.close()
+    create_search_index(engine)
+    return engine
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200_000)
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Session(build(os.path.join(tmp, 'search.db'), args.rows))
+        like = text("SELECT id FROM articles WHERE title LIKE :q OR content LIKE :q LIMIT :limit")
+
+        fts_ms = timed(lambda: search_articles(db, 'needle', args.limit), args.repeat)
+        like_ms = timed(lambda: db.execute(like, {'q': '%needle%', 'limit': args.limit}).all(), args.repeat)
+        print(f"{'rows':>10} {'fts5 ms':>10} {'like ms':>10}")
+        print(f"{args.rows:>10} {fts_ms:>10.2f} {like_ms:>10.2f}")
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Response serialization of a page of users: fastapi's response_model path vs the direct one in serialization.py.
+
+    python benchmarks/bench_serialization.py --rows 1000 --articles 3
+
+The rows are built in memory, so only serialization is timed. The response_model path is what fastapi does
+with a returned page: validate it into UserPage, jsonable_encoder, then stdlib json (JSONResponse) or orjson
+(ORJSONResponse). The direct path reads the rows straight into orjson.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from db.models import DbArticle, DbUser
+from schemas import UserPage
+from serialization import dumps
+
+
+def build(rows, articles):
+    users = []
+    for id in range(rows):
+        user = DbUser(id=id, username=f'user{id}', email=f'user{id}@bench.com', password='x')
+        user.items = [DbArticle(id=id * articles + n, title=f'title {n}', content='content ' * 20, published=True)
+                      for n in range(articles)]
+        users.append(user)
+    return {'items': users, 'next_cursor': None}
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--articles', type=int, default=3, help='articles per user')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    page = build(args.rows, args.articles)
+    field = create_response_field('response', UserPage)
+
+    def response_model(response_class):
+        # is_coroutine=True validates inline rather than on the threadpool
+        content = asyncio.run(serialize_response(field=field, response_content=page, is_coroutine=True))
+        return response_class(content).body
+
+    # both give the same document
+    assert json.loads(dumps(page, UserPage)) == json.loads(response_model(JSONResponse))
+    results = {
+        'response_model + json': timed(lambda: response_model(JSONResponse), args.repeat),
+        'response_model + orjson': timed(lambda: response_model(ORJSONResponse), args.repeat),
+        'direct orjson': timed(lambda: dumps(page, UserPage), args.repeat),
+    }
+    print(f"{'path':>24} {'ms':>10}")
+    for name, ms in results.items():
+        print(f"{name:>24} {ms:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
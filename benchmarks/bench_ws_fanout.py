@@ -0,0 +1,89 @@
+"""
+Broadcast delivery latency through chat.hub with simulated websocket clients.
+
+    python benchmarks/bench_ws_fanout.py --clients 10000 --messages 50 --slow 100
+
+Every client is an in-process fake socket whose send_text takes --send-ms (or --slow-ms for
+the --slow slowest clients). Each message carries its publish time, so a client measures
+delivery latency when it "sends". Slow clients shouldn't move the latency of the rest.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat.hub import Hub
+
+
+class FakeSocket:
+    def __init__(self, delay, latencies):
+        self.delay = delay
+        self.latencies = latencies
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        # frames are {"seq": n, "data": message}
+        self.latencies.append(time.perf_counter() - float(json.loads(message)['data']))
+
+    async def close(self, code=1000):
+        pass
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] if values else float('nan')
+
+
+async def run(args):
+    hub = Hub(queue_size=args.queue_size, policy=args.policy)
+    fast, slow = [], []
+    for i in range(args.clients):
+        is_slow = i < args.slow
+        socket = FakeSocket(args.slow_ms / 1000 if is_slow else args.send_ms / 1000, slow if is_slow else fast)
+        await hub.connect(socket, 'bench')
+
+    start = time.perf_counter()
+    broadcast_time = 0
+    for _ in range(args.messages):
+        sent = time.perf_counter()
+        hub.broadcast('bench', repr(sent))
+        broadcast_time += time.perf_counter() - sent
+        await asyncio.sleep(args.interval_ms / 1000)
+    # let the fast clients drain
+    expected = (args.clients - args.slow) * args.messages
+    while len(fast) < expected and time.perf_counter() - start < 60:
+        await asyncio.sleep(0.01)
+
+    print(f"clients {args.clients}, slow {args.slow}, messages {args.messages}, policy {args.policy}")
+    print(f"broadcast call     {broadcast_time / args.messages * 1000:8.2f} ms per message")
+    print(f"fast delivered     {len(fast):8d} / {expected}")
+    print(f"fast latency p50   {percentile(fast, 50) * 1000:8.2f} ms")
+    print(f"fast latency p99   {percentile(fast, 99) * 1000:8.2f} ms")
+    print(f"slow delivered     {len(slow):8d}")
+    print(f"hub                {hub.stats()}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--messages', type=int, default=50)
+    parser.add_argument('--slow', type=int, default=100)
+    parser.add_argument('--send-ms', type=float, default=0)
+    parser.add_argument('--slow-ms', type=float, default=1000)
+    parser.add_argument('--interval-ms', type=float, default=20)
+    parser.add_argument('--queue-size', type=int, default=16)
+    parser.add_argument('--policy', choices=['drop_oldest', 'disconnect'], default='drop_oldest')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+from array import array
+
+
+class History:
+    """
+    the last `size` frames sent to a room, so a client that reconnects can ask for what it missed.
+    slots are allocated once up front and overwritten in place; a frame is stored by reference, not copied.
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self.frames = [None] * size
+        # seq of the frame in each slot, 0 for an empty slot
+        self.seqs = array('q', bytes(8 * size))
+        self.last = 0
+
+    def append(self, seq: int, frame: str):
+        if seq <= self.last:
+            # the numbering started over (a new broker took over), what we hold can't be resumed from
+            self.clear()
+        slot = seq % self.size
+        self.frames[slot] = frame
+        self.seqs[slot] = seq
+        self.last = seq
+
+    def clear(self):
+        self.frames = [None] * self.size
+        self.seqs = array('q', bytes(8 * self.size))
+        self.last = 0
+
+    def since(self, last_seen: int):
+        """frames after last_seen, oldest first. all of them when last_seen is from before a restart."""
+        if last_seen > self.last:
+            last_seen = 0
+        first = max(last_seen + 1, self.last - self.size + 1)
+        frames = []
+        for seq in range(first, self.last + 1):
+            slot = seq % self.size
+            # a slot can hold an older frame when this worker missed some of the numbering
+            if self.seqs[slot] == seq:
+                frames.append(self.frames[slot])
+        return frames
@@ -0,0 +1,140 @@
+import asyncio
+import json
+from collections import OrderedDict, defaultdict
+
+from fastapi.websockets import WebSocket
+
+from chat.history import History
+from settings import WS_HISTORY_ROOMS, WS_HISTORY_SIZE, WS_QUEUE_SIZE, WS_SLOW_CONSUMER_POLICY
+
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+# "try again later", sent to clients disconnected for being too slow
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+
+class Connection:
+    """one websocket, with its own bounded send queue drained by its own writer task."""
+    def __init__(self, hub, websocket: WebSocket, room: str, replay=()):
+        self.hub = hub
+        self.websocket = websocket
+        self.room = room
+        # missed frames, sent ahead of the queue and not counted against it
+        self.replay = replay
+        self.queue = asyncio.Queue(maxsize=hub.queue_size)
+        self.closed = False
+        self.writer = None
+        self.closer = None
+
+    def offer(self, message: str):
+        """queue message without waiting, returns False when the client should be disconnected."""
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            pass
+        if self.hub.policy == DISCONNECT:
+            return False
+        self.queue.get_nowait()
+        self.queue.put_nowait(message)
+        self.hub.dropped += 1
+        return True
+
+    async def write(self):
+        try:
+            for frame in self.replay:
+                await self.websocket.send_text(frame)
+            self.replay = ()
+            while True:
+                message = await self.queue.get()
+                await self.websocket.send_text(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # the socket is gone, the receive loop will notice too
+            self.hub.disconnect(self)
+
+
+class Hub:
+    """
+    websocket fan-out by room. every message goes out as {"seq": n, "data": message}, and the last
+    history_size frames of each room are kept so a client can reconnect with last_seen=n to get what it missed.
+    """
+    def __init__(self, queue_size: int = WS_QUEUE_SIZE, policy: str = WS_SLOW_CONSUMER_POLICY,
+                 history_size: int = WS_HISTORY_SIZE, history_rooms: int = WS_HISTORY_ROOMS):
+        if policy not in (DROP_OLDEST, DISCONNECT):
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.queue_size = queue_size
+        self.policy = policy
+        self.history_size = history_size
+        self.history_rooms = history_rooms
+        self.rooms = defaultdict(set)
+        # kept after a room empties, that's when its clients are most likely to be reconnecting. but room names
+        # come from the clients, so only for history_rooms rooms, least recently messaged first out
+        self.histories = OrderedDict()
+        self.dropped = 0
+        self.slow_disconnects = 0
+
+    async def connect(self, websocket: WebSocket, room: str, last_seen: int = None):
+        await websocket.accept()
+        history = self.histories.get(room)
+        replay = history.since(last_seen) if history is not None and last_seen is not None else ()
+        # no await between the replay and joining the room, so nothing is missed or sent twice
+        connection = Connection(self, websocket, room, replay)
+        connection.writer = asyncio.create_task(connection.write())
+        self.rooms[room].add(connection)
+        return connection
+
+    def disconnect(self, connection: Connection):
+        if connection.closed:
+            return
+        connection.closed = True
+        members = self.rooms.get(connection.room)
+        if members is not None:
+            members.discard(connection)
+            if not members:
+                del self.rooms[connection.room]
+        if connection.writer is not None and connection.writer is not asyncio.current_task():
+            connection.writer.cancel()
+
+    def broadcast(self, room: str, message: str, seq: int = None):
+        # seq is given when it comes from the broker shared by all workers, otherwise numbered here
+        history = self.histories.get(room)
+        if history is None:
+            history = self.histories[room] = History(self.history_size)
+            if len(self.histories) > self.history_rooms:
+                self.forget_history()
+        else:
+            self.histories.move_to_end(room)
+        if seq is None:
+            seq = history.last + 1
+        # formatted once, the same string is queued for every client
+        frame = json.dumps({'seq': seq, 'data': message})
+        history.append(seq, frame)
+        # offer never waits, so one slow client can't hold up delivery to everyone else
+        slow = [connection for connection in self.rooms.get(room, ()) if not connection.offer(frame)]
+        for connection in slow:
+            self.slow_disconnects += 1
+            self.disconnect(connection)
+            connection.closer = asyncio.create_task(connection.websocket.close(code=SLOW_CONSUMER_CLOSE_CODE))
+
+    def forget_history(self):
+        # the room that has gone longest without a message, one nobody is in if there is one
+        for room in self.histories:
+            if room not in self.rooms:
+                break
+        else:
+            room = next(iter(self.histories))
+        del self.histories[room]
+
+    def stats(self):
+        return {
+            'rooms': len(self.rooms),
+            'histories': len(self.histories),
+            'connections': sum(len(members) for members in self.rooms.values()),
+            'dropped': self.dropped,
+            'slow_disconnects': self.slow_disconnects,
+        }
+
+
+hub = Hub()
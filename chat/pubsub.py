@@ -0,0 +1,230 @@
+import asyncio
+import os
+import struct
+from collections import OrderedDict, deque
+
+from chat.hub import hub
+from logs.logging import log
+from settings import CHAT_BACKEND, CHAT_SOCKET_PATH, CHAT_TICK_MS, WS_HISTORY_ROOMS
+
+# chat messages are published here rather than straight to the hub, so that with several uvicorn
+# workers a message reaches the clients connected to every worker, not just the one it arrived on.
+
+# frame: room length, message length, room, message (utf-8)
+HEADER = struct.Struct('!II')
+# frames from the broker also carry the room's sequence number, the same on every worker
+RELAY_HEADER = struct.Struct('!IIQ')
+# messages published while the broker is unreachable, oldest are dropped past this
+MAX_OUTBOX = 10000
+# a worker that has let this much pile up unread is dropped by the broker, it reconnects
+MAX_CLIENT_BUFFER = 16 * 1024 * 1024
+
+
+def encode(room: str, message: str):
+    room_bytes, message_bytes = room.encode(), message.encode()
+    return HEADER.pack(len(room_bytes), len(message_bytes)) + room_bytes + message_bytes
+
+
+async def read_relayed_frame(reader: asyncio.StreamReader):
+    room_length, message_length, seq = RELAY_HEADER.unpack(await reader.readexactly(RELAY_HEADER.size))
+    body = await reader.readexactly(room_length + message_length)
+    return body[:room_length], body[room_length:], seq
+
+
+class InMemoryPubSub:
+    """single process, publish goes straight to the local hub."""
+    def __init__(self, deliver):
+        self.deliver = deliver
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def publish(self, room: str, message: str):
+        self.deliver(room, message)
+
+
+class Broker:
+    """
+    relays frames between the workers on this host. frames from every worker are collected for a tick
+    and then written to every worker (the sender included) in one write per worker.
+    numbering messages here gives every worker the same sequence numbers, so a client can resume on any of them.
+    """
+    def __init__(self, path: str, tick: float, max_rooms: int = WS_HISTORY_ROOMS):
+        self.path = path
+        self.tick = tick
+        self.clients = set()
+        self.pending = []
+        # least recently messaged first. dropped in the same order as the workers drop their histories, and
+        # a room that starts over from 1 is taken as a restart by them, see History.append
+        self.seqs = OrderedDict()
+        self.max_rooms = max_rooms
+        self.server = None
+        self.flusher = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            # left behind by a broker that died, we hold the lock so nobody else is using it
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self.handle, path=self.path)
+
+    async def stop(self):
+        self.server.close()
+        for writer in list(self.clients):
+            writer.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.clients.add(writer)
+        try:
+            while True:
+                room_length, message_length = HEADER.unpack(await reader.readexactly(HEADER.size))
+                # relayed as is, the broker never decodes a message
+                body = await reader.readexactly(room_length + message_length)
+                room = body[:room_length]
+                seq = self.seqs[room] = self.seqs.pop(room, 0) + 1
+                if len(self.seqs) > self.max_rooms:
+                    self.seqs.popitem(last=False)
+                self.pending.append(RELAY_HEADER.pack(room_length, message_length, seq) + body)
+                if self.flusher is None:
+                    self.flusher = asyncio.get_running_loop().call_later(self.tick, self.flush)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    def flush(self):
+        self.flusher = None
+        data, self.pending = b''.join(self.pending), []
+        for writer in list(self.clients):
+            if writer.transport.get_write_buffer_size() > MAX_CLIENT_BUFFER:
+                self.clients.discard(writer)
+                writer.close()
+                continue
+            writer.write(data)
+
+
+class UnixSocketPubSub:
+    """
+    several workers on one host. every worker connects to a broker on a unix domain socket;
+    the first worker to take the lock file runs the broker, and another takes over if it dies.
+    publishes are batched per tick, so a burst of messages is one write rather than one per message.
+    """
+    def __init__(self, deliver, path: str = CHAT_SOCKET_PATH, tick_ms: float = CHAT_TICK_MS):
+        self.deliver = deliver
+        self.path = path
+        self.tick = tick_ms / 1000
+        self.outbox = deque(maxlen=MAX_OUTBOX)
+        self.writer = None
+        self.flusher = None
+        self.broker = None
+        self.lock_file = None
+        self.task = None
+        # logged once rather than on every retry
+        self.last_error = None
+
+    async def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.broker is not None:
+            await self.broker.stop()
+            self.broker = None
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def publish(self, room: str, message: str):
+        self.outbox.append(encode(room, message))
+        if self.flusher is None and self.writer is not None:
+            self.flusher = asyncio.get_running_loop().call_later(self.tick, self.flush)
+
+    def flush(self):
+        self.flusher = None
+        if self.writer is None or not self.outbox:
+            return
+        data = b''.join(self.outbox)
+        self.outbox.clear()
+        self.writer.write(data)
+
+    def try_lock(self):
+        # unix only, like the rest of this backend. imported here so CHAT_BACKEND=memory runs anywhere
+        import fcntl
+        lock_file = open(self.path + '.lock', 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    def failed(self, what: str, error: Exception):
+        if repr(error) != self.last_error:
+            self.last_error = repr(error)
+            log('chat', f"{what} on {self.path} failed, retrying: {error!r}")
+
+    async def start_broker(self):
+        """true once this worker runs the broker, false when another one does or it couldn't be started."""
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', mode=0o700, exist_ok=True)
+            if not self.try_lock():
+                return False
+            broker = Broker(self.path, self.tick)
+            await broker.start()
+        except OSError as error:
+            self.failed('Starting the chat broker', error)
+            if self.lock_file is not None:
+                self.lock_file.close()
+                self.lock_file = None
+            return False
+        self.broker = broker
+        return True
+
+    async def run(self):
+        delay = self.tick
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError as error:
+                if not isinstance(error, (FileNotFoundError, ConnectionRefusedError)):
+                    self.failed('Connecting to the chat broker', error)
+                elif self.broker is None and await self.start_broker():
+                    continue
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 1)
+                continue
+
+            delay = self.tick
+            self.last_error = None
+            self.writer = writer
+            # anything published while we weren't connected
+            self.flush()
+            try:
+                while True:
+                    room, message, seq = await read_relayed_frame(reader)
+                    self.deliver(room.decode(), message.decode(), seq)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            finally:
+                self.writer = None
+                writer.close()
+
+
+def make_pubsub(deliver):
+    if CHAT_BACKEND == 'unix':
+        return UnixSocketPubSub(deliver)
+    return InMemoryPubSub(deliver)
+
+
+pubsub = make_pubsub(hub.broadcast)
@@ -13,14 +13,26 @@ html = """
         <ul id='messages'>
         </ul>
         <script>
-            var ws = new WebSocket("ws://localhost:8000/endpoint");
-            ws.onmessage = function(event) {
-                var messages = document.getElementById('messages')
-                var message = document.createElement('li')
-                var content = document.createTextNode(event.data)
-                message.appendChild(content)
-                messages.appendChild(message)
-            };
+            var ws
+            var lastSeen = null
+            function connect() {
+                // after a dropped connection, ask for the messages sent since the last one we saw
+                var url = "ws://localhost:8000/endpoint"
+                ws = new WebSocket(lastSeen === null ? url : url + "?last_seen=" + lastSeen)
+                ws.onmessage = function(event) {
+                    var frame = JSON.parse(event.data)
+                    lastSeen = frame.seq
+                    var messages = document.getElementById('messages')
+                    var message = document.createElement('li')
+                    var content = document.createTextNode(frame.data)
+                    message.appendChild(content)
+                    messages.appendChild(message)
+                };
+                ws.onclose = function() {
+                    setTimeout(connect, 1000)
+                };
+            }
+            connect()
             function sendMessage(event) {
                 var input = document.getElementById("messageText")
                 ws.send(input.value)
@@ -0,0 +1,179 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+from db.database import AsyncSessionLocal
+from settings import CACHE_BACKEND, CACHE_MAXSIZE, CACHE_TTL_SECONDS, PRINCIPAL_CACHE_TTL_SECONDS
+
+# in process read-through caches for hot lookups.
+# values are cached as pydantic display models rather than orm rows, as rows are tied to the session that loaded them.
+# each worker process has its own caches, so ttl bounds how stale another worker's write can look.
+
+
+class _Pending:
+    """a load in flight, concurrent misses for the same key wait on it instead of querying again."""
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class LRUCache:
+    def __init__(self, name: str, maxsize: int = CACHE_MAXSIZE, ttl: float = CACHE_TTL_SECONDS):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._async_pending = {}
+        # bumped by every invalidation, a load that started before one isn't cached
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lookup(self, key):
+        # caller holds the lock
+        entry = self._data.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return True, value
+            del self._data[key]
+        self.misses += 1
+        return False, None
+
+    def _store(self, key, value, version):
+        # caller holds the lock
+        if version != self._version:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key):
+        with self._lock:
+            return self._lookup(key)
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value, self._version)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._version += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._data.clear()
+
+    def get_or_load(self, key, loader):
+        """return the cached value for key, or call loader() once however many threads miss at the same time."""
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                return value
+            pending = self._pending.get(key)
+            leader = pending is None
+            if leader:
+                pending = self._pending[key] = _Pending()
+            version = self._version
+
+        if not leader:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.value
+
+        try:
+            pending.value = loader()
+        except BaseException as error:
+            pending.error = error
+            raise
+        finally:
+            with self._lock:
+                if pending.error is None:
+                    self._store(key, pending.value, version)
+                del self._pending[key]
+            pending.event.set()
+        return pending.value
+
+    async def aget_or_load(self, key, loader):
+        """
+        get_or_load for the async path, loader is a coroutine function taking an AsyncSession. the load runs in
+        a task of its own with a session of its own, so the caller that started it being cancelled (its client
+        went away) and closing its session doesn't fail it for the others waiting on the same key.
+        """
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                return value
+            version = self._version
+        task = self._async_pending.get(key)
+        if task is None:
+            task = self._async_pending[key] = asyncio.ensure_future(self._aload(key, loader, version))
+            # mark a failure retrieved, so a load every waiter gave up on doesn't log "exception never retrieved"
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        return await asyncio.shield(task)
+
+    async def _aload(self, key, loader, version):
+        try:
+            async with AsyncSessionLocal() as db:
+                value = await loader(db)
+            with self._lock:
+                self._store(key, value, version)
+            return value
+        finally:
+            del self._async_pending[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class NullCache(LRUCache):
+    """CACHE_BACKEND=none, every lookup goes to the database but is still counted."""
+    def _store(self, key, value, version):
+        pass
+
+
+caches = {}
+
+
+def make_cache(name: str, maxsize: int = CACHE_MAXSIZE, ttl: float = CACHE_TTL_SECONDS):
+    backend = {'lru': LRUCache, 'none': NullCache}[CACHE_BACKEND]
+    cache = caches[name] = backend(name, maxsize, ttl)
+    return cache
+
+
+def cache_stats():
+    return {name: cache.stats() for name, cache in caches.items()}
+
+
+# keyed by user id, holds UserDisplay
+user_cache = make_cache('user')
+# keyed by article id, holds ArticleUser
+article_cache = make_cache('article')
+# keyed by username (the token subject), holds User
+principal_cache = make_cache('principal', ttl=PRINCIPAL_CACHE_TTL_SECONDS)
+
+
+def forget_user(id: int, *usernames: str):
+    # called once a user's row has changed or gone
+    user_cache.invalidate(id)
+    for username in usernames:
+        principal_cache.invalidate(username)
@@ -1,26 +1,167 @@
-import os
-
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool, QueuePool
+import time
+
+from db.instrumentation import instrument
+from logs.logging import log
+from metrics.registry import registry, db_checkout_duration, db_checked_out
 
-from settings import PROJECT_DIR
+from settings import (DATABASE_PATH, DB_PROFILE, DB_SYNCHRONOUS, DB_MMAP_SIZE, DB_CACHE_SIZE,
+                      DB_BUSY_TIMEOUT_MS, DB_POOL_SIZE, DB_READ_POOL_SIZE)
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./fastapi-practice.db"
 # needed for testing...
-SQLALCHEMY_DATABASE_URL_REL = 'sqlite:///' + os.path.join(PROJECT_DIR, 'fastapi-practice.db')
+SQLALCHEMY_DATABASE_URL_REL = 'sqlite:///' + DATABASE_PATH
+# same file, driven through aiosqlite so queries can be awaited on the event loop
+ASYNC_SQLALCHEMY_DATABASE_URL = 'sqlite+aiosqlite:///' + DATABASE_PATH
+# same file again, opened read only for the GET handlers
+READ_ONLY_DATABASE_URL = 'sqlite:///file:' + DATABASE_PATH + '?mode=ro&uri=true'
+
+PRODUCTION = DB_PROFILE == "production"
+
+
+def set_sqlite_pragmas(dbapi_connection, read_only=False):
+    cursor = dbapi_connection.cursor()
+    # WAL lets readers carry on while create_user/create_article are writing
+    if not read_only:
+        cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size={DB_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    if read_only:
+        cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+
+def timed_pool(pool_class, label: str):
+    # a subclass rather than an instance attribute, engine.dispose() recreates the pool from its class
+    class TimedPool(pool_class):
+        def connect(self):
+            start = time.perf_counter()
+            try:
+                return super().connect()
+            finally:
+                db_checkout_duration.observe((label,), time.perf_counter() - start)
+    return TimedPool
+
+
+def profile_options(pool_size: int, label: str):
+    # file based sqlite uses a NullPool by default, which reconnects (and re-runs the pragmas) per session
+    if not PRODUCTION:
+        return {'poolclass': timed_pool(NullPool, label)}
+    return {'poolclass': timed_pool(QueuePool, label), 'pool_size': pool_size, 'max_overflow': pool_size}
+
 
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL_REL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL_REL, connect_args={"check_same_thread": False}, **profile_options(DB_POOL_SIZE, 'write')
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL, poolclass=timed_pool(NullPool, 'async'))
+# expire_on_commit=False as an AsyncSession can't lazily reload attributes after a commit
+AsyncSessionLocal = sessionmaker(
+    async_engine, class_=AsyncSession, autocommit=False, autoflush=False, expire_on_commit=False
+)
+
+if PRODUCTION:
+    read_engine = create_engine(
+        READ_ONLY_DATABASE_URL, connect_args={"check_same_thread": False}, **profile_options(DB_READ_POOL_SIZE, 'read')
+    )
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        set_sqlite_pragmas(dbapi_connection)
+
+    @event.listens_for(async_engine.sync_engine, "connect")
+    def on_async_connect(dbapi_connection, connection_record):
+        set_sqlite_pragmas(dbapi_connection)
+
+    @event.listens_for(read_engine, "connect")
+    def on_read_connect(dbapi_connection, connection_record):
+        set_sqlite_pragmas(dbapi_connection, read_only=True)
+else:
+    read_engine = engine
+
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+# query counts, timings and the slow query log, see db/instrumentation.py
+for bind in {engine, read_engine, async_engine.sync_engine}:
+    instrument(bind)
+
+
+def collect_pool_usage():
+    for label, pool in (('write', engine.pool), ('read', read_engine.pool)):
+        if isinstance(pool, QueuePool):
+            db_checked_out.set((label,), pool.checkedout())
+
+
+registry.collectors.append(collect_pool_usage)
+
 # used to create our models.
 Base = declarative_base()
 
+
+def add_missing_columns(bind):
+    # create_all doesn't add columns to tables that already exist either. only nullable ones can be added
+    inspector = inspect(bind)
+    with bind.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    column_type = column.type.compile(dialect=bind.dialect)
+                    connection.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+
+
+def has_duplicates(bind, index):
+    columns = ', '.join(column.name for column in index.columns)
+    with bind.connect() as connection:
+        statement = f'SELECT 1 FROM {index.table.name} GROUP BY {columns} HAVING COUNT(*) > 1 LIMIT 1'
+        return connection.exec_driver_sql(statement).first() is not None
+
+
+def create_missing_indexes(bind):
+    # create_all skips tables that already exist, including any index added to them later
+    inspector = inspect(bind)
+    for table in Base.metadata.sorted_tables:
+        existing = {index['name']: index for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            found = existing.get(index.name)
+            if index.unique and (found is None or not found['unique']) and has_duplicates(bind, index):
+                # made unique since it was created (users.username), on a database that already has duplicates.
+                # left as it is rather than failing to start, until they're sorted out by hand
+                log('db', f"Not making {index.name} unique, {table.name} has rows with the same "
+                          f"{', '.join(column.name for column in index.columns)}")
+                continue
+            if found is not None and bool(found['unique']) != bool(index.unique):
+                index.drop(bind=bind)
+                found = None
+            if found is None:
+                index.create(bind=bind)
+
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+
+def get_read_db():
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -1,13 +1,24 @@
 from db.models import DbArticle
-from schemas import ArticleBase
+from db.cache import article_cache, user_cache
+from db.loading import eager_options
+from db.pagination import DEFAULT_LIMIT, keyset, page
+from schemas import ArticleBase, ArticleDisplay, ArticleUser
+from sqlalchemy import insert, select
 from sqlalchemy.orm.session import Session
 from fastapi import HTTPException, status
 from exceptions import EmailException
 import re
 
+EMAIL = re.compile(r'[\w.+-]+@[\w-]+\.[\w.-]+')
+
+
+def find_emails(content: str):
+    # most articles have no @ at all, which `in` finds out far quicker than the regex
+    return EMAIL.findall(content) if '@' in content else []
+
 
 def create_article(db: Session, request: ArticleBase):
-    list_of_emails = re.findall(r'[\w.+-]+@[\w-]+\.[\w.-]+', request.content)
+    list_of_emails = find_emails(request.content)
     if list_of_emails:
         raise EmailException(f"Content contains email(s): {', '.join(list_of_emails)}")
 
@@ -19,13 +30,37 @@ def create_article(db: Session, request: ArticleBase):
     )
     db.add(new_article)
     db.commit()
+    # the creator's cached UserDisplay.items is now missing this article
+    user_cache.invalidate(request.creator_id)
     # so we can get the id of the article...
     db.refresh(new_article)
     return new_article
 
 
+# rows are dicts of title, content, published and user_id. one executemany and one commit for all of them
+def create_articles(db: Session, rows: list):
+    db.execute(insert(DbArticle), rows)
+    db.commit()
+    for user_id in {row['user_id'] for row in rows}:
+        user_cache.invalidate(user_id)
+
+
+# read through article_cache, so this returns an ArticleUser rather than the DbArticle row
 def get_article(db: Session, id: int):
-    article = db.query(DbArticle).filter(DbArticle.id == id).first()
-    if not article:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Article with id: {id} not found")
-    return article
+    def load():
+        article = db.query(DbArticle).filter(DbArticle.id == id).first()
+        if not article:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Article with id: {id} not found")
+        return ArticleUser.from_orm(article)
+    return article_cache.get_or_load(id, load)
+
+
+def get_all_articles(db: Session, limit: int = DEFAULT_LIMIT, after: str = None, display=ArticleDisplay):
+    statement = keyset(select(DbArticle).options(*eager_options(DbArticle, display)), DbArticle.id, limit, after)
+    return page(db.execute(statement).scalars().all(), 'id', limit)
+
+
+# every article, fetched from sqlite batch_size rows at a time rather than all at once
+def iter_articles(db: Session, batch_size: int, display=ArticleDisplay):
+    statement = select(DbArticle).options(*eager_options(DbArticle, display)).order_by(DbArticle.id)
+    return db.execute(statement.execution_options(yield_per=batch_size)).scalars()
@@ -0,0 +1,52 @@
+from db.models import DbArticle
+from db.cache import article_cache, user_cache
+from db.db_article import find_emails
+from db.loading import eager_options
+from db.pagination import DEFAULT_LIMIT, keyset, page
+from schemas import ArticleBase, ArticleDisplay, ArticleUser
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import HTTPException, status
+from exceptions import EmailException
+
+# async versions of db_article.
+
+
+async def create_article(db: AsyncSession, request: ArticleBase):
+    list_of_emails = find_emails(request.content)
+    if list_of_emails:
+        raise EmailException(f"Content contains email(s): {', '.join(list_of_emails)}")
+
+    new_article = DbArticle(
+        title=request.title,
+        content=request.content,
+        published=request.published,
+        user_id=request.creator_id
+    )
+    db.add(new_article)
+    await db.commit()
+    # the creator's cached UserDisplay.items is now missing this article
+    user_cache.invalidate(request.creator_id)
+    # ArticleDisplay needs the creator, which can't be lazy loaded here.
+    result = await db.execute(
+        select(DbArticle).options(*eager_options(DbArticle, ArticleDisplay)).filter(DbArticle.id == new_article.id)
+    )
+    return result.scalars().first()
+
+
+# read through article_cache, so this returns an ArticleUser rather than the DbArticle row.
+# a miss is loaded on a session of the cache's, not db, see LRUCache.aget_or_load
+async def get_article(db: AsyncSession, id: int):
+    async def load(db: AsyncSession):
+        result = await db.execute(select(DbArticle).filter(DbArticle.id == id))
+        article = result.scalars().first()
+        if not article:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Article with id: {id} not found")
+        return ArticleUser.from_orm(article)
+    return await article_cache.aget_or_load(id, load)
+
+
+async def get_all_articles(db: AsyncSession, limit: int = DEFAULT_LIMIT, after: str = None, display=ArticleDisplay):
+    statement = keyset(select(DbArticle).options(*eager_options(DbArticle, display)), DbArticle.id, limit, after)
+    result = await db.execute(statement)
+    return page(result.scalars().all(), 'id', limit)
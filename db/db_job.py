@@ -0,0 +1,67 @@
+import json
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_, update
+from sqlalchemy.orm.session import Session
+from db.models import DbJob
+from schemas import JobDisplay
+
+# jobs are written from the job worker threads, each call gets its own session.
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def create_job(db: Session, id: str, name: str, params: dict):
+    db.add(DbJob(id=id, name=name, params=json.dumps(params), status=QUEUED, created_at=datetime.utcnow()))
+    db.commit()
+
+
+def claim_job(db: Session, id: str, owner: str, lease_seconds: float):
+    """true when this owner gets to run the job: it's queued, or was left running with its lease run out."""
+    now = datetime.utcnow()
+    result = db.execute(
+        update(DbJob)
+        .where(DbJob.id == id, or_(DbJob.status == QUEUED,
+                                   and_(DbJob.status == RUNNING,
+                                        or_(DbJob.lease_until.is_(None), DbJob.lease_until < now))))
+        .values(status=RUNNING, owner=owner, lease_until=now + timedelta(seconds=lease_seconds))
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return result.rowcount == 1
+
+
+def renew_leases(db: Session, ids: list, owner: str, lease_seconds: float):
+    db.execute(
+        update(DbJob)
+        .where(DbJob.id.in_(ids), DbJob.owner == owner, DbJob.status == RUNNING)
+        .values(lease_until=datetime.utcnow() + timedelta(seconds=lease_seconds))
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+
+
+def update_job(db: Session, id: str, owner: str, status: str, result=None, error: str = None):
+    # only while the job is still this owner's, another worker may have taken it over
+    values = {'status': status, 'result': json.dumps(result), 'error': error}
+    if status in (DONE, FAILED):
+        values['finished_at'] = datetime.utcnow()
+    db.execute(update(DbJob).where(DbJob.id == id, DbJob.owner == owner).values(**values)
+               .execution_options(synchronize_session=False))
+    db.commit()
+
+
+def get_job(db: Session, id: str):
+    job = db.query(DbJob).filter(DbJob.id == id).first()
+    if job is None:
+        return None
+    return JobDisplay(id=job.id, name=job.name, status=job.status,
+                      result=json.loads(job.result) if job.result else None, error=job.error)
+
+
+def get_unfinished_jobs(db: Session):
+    # a "running" job may be running on another worker, claim_job only lets it be taken once its lease is up
+    jobs = db.query(DbJob).filter(DbJob.status.in_([QUEUED, RUNNING])).order_by(DbJob.created_at).all()
+    return [(job.id, job.name, json.loads(job.params)) for job in jobs]
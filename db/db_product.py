@@ -0,0 +1,81 @@
+import html
+import threading
+import time
+from sqlalchemy import insert, select, update
+from sqlalchemy.orm.session import Session
+from db.cache import make_cache
+from db.models import DbCatalogVersion, DbProduct
+from settings import CATALOG_VERSION_CHECK_SECONDS
+
+# the product catalog lives in the database so every worker sees the same one.
+# responses are rendered once and cached per worker; a write anywhere bumps catalog_version, and each
+# worker drops its cache when it sees the version move (checked at most every CATALOG_VERSION_CHECK_SECONDS).
+
+# keyed by product id, holds the rendered html. ALL_NAMES holds the list of names.
+product_cache = make_cache('product')
+ALL_NAMES = 'all'
+
+DEFAULT_PRODUCTS = ['watch', 'camera', 'phone']
+
+_lock = threading.Lock()
+_version = None
+_checked_at = 0.0
+
+
+def seed_products(bind):
+    with bind.begin() as connection:
+        if connection.execute(select(DbCatalogVersion.id)).first() is None:
+            connection.execute(insert(DbCatalogVersion).values(id=1, version=0))
+        if connection.execute(select(DbProduct.id)).first() is None:
+            connection.execute(insert(DbProduct), [{'name': name} for name in DEFAULT_PRODUCTS])
+
+
+def _seen(version: int):
+    # caller holds the lock
+    global _version, _checked_at
+    if version != _version:
+        product_cache.clear()
+        _version = version
+    _checked_at = time.monotonic()
+
+
+def check_version(db: Session, force: bool = False):
+    with _lock:
+        if not force and time.monotonic() - _checked_at < CATALOG_VERSION_CHECK_SECONDS:
+            return
+    version = db.execute(select(DbCatalogVersion.version).where(DbCatalogVersion.id == 1)).scalar()
+    with _lock:
+        _seen(version)
+
+
+def render(product: DbProduct):
+    return f'''
+        <head>
+           '{html.escape(product.name)}'
+        </head>
+        '''
+
+
+def get_product_html(db: Session, id: int):
+    """the rendered product, None when there's no product with that id."""
+    check_version(db)
+
+    def load():
+        product = db.get(DbProduct, id)
+        return None if product is None else render(product)
+
+    return product_cache.get_or_load(id, load)
+
+
+def get_product_names(db: Session):
+    check_version(db)
+    return product_cache.get_or_load(ALL_NAMES, lambda: db.execute(select(DbProduct.name).order_by(DbProduct.id)).scalars().all())
+
+
+def create_product(db: Session, name: str):
+    db.add(DbProduct(name=name))
+    # in the same transaction as the insert, so no worker can see the product but not the new version
+    db.execute(update(DbCatalogVersion).where(DbCatalogVersion.id == 1).values(version=DbCatalogVersion.version + 1))
+    db.commit()
+    # this worker's own cache shouldn't wait for the next check
+    check_version(db, force=True)
@@ -0,0 +1,66 @@
+import hashlib
+import secrets
+from datetime import datetime, timedelta
+from sqlalchemy import update
+from sqlalchemy.orm.session import Session
+from fastapi import HTTPException, status
+from db.models import DbRefreshToken
+from settings import REFRESH_TOKEN_EXPIRE_DAYS
+
+# refresh tokens are 256 bit random strings, so a fast sha256 is enough to store them safely (unlike passwords).
+
+
+def _digest(token: str):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _invalid():
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid refresh token",
+        headers={"WWW-Authenticate": "Bearer"}
+    )
+
+
+def revoke_statement(user_id: int):
+    # every refresh token of the user, works with a Session and an AsyncSession
+    return update(DbRefreshToken).where(DbRefreshToken.user_id == user_id).values(revoked=True)
+
+
+def create_refresh_token(db: Session, user_id: int):
+    token = secrets.token_urlsafe(32)
+    expires = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    db.add(DbRefreshToken(token_hash=_digest(token), user_id=user_id, expires_at=expires, revoked=False))
+    db.commit()
+    return token, expires
+
+
+def rotate_refresh_token(db: Session, token: str):
+    """swap a refresh token for a new one, returns (user, new token, expiry)."""
+    stored = db.query(DbRefreshToken).filter(DbRefreshToken.token_hash == _digest(token)).first()
+    if not stored or stored.expires_at < datetime.utcnow() or stored.user is None:
+        raise _invalid()
+    # checked and revoked in one statement, so of two refreshes racing with the same token only one wins
+    result = db.execute(
+        update(DbRefreshToken)
+        .where(DbRefreshToken.token_hash == stored.token_hash, DbRefreshToken.revoked == False)  # noqa: E712
+        .values(revoked=True)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        # a rotated token coming back means it leaked, so end every session of the user
+        db.execute(revoke_statement(stored.user_id))
+        db.commit()
+        raise _invalid()
+    user = stored.user
+    new_token, expires = create_refresh_token(db, user.id)
+    return user, new_token, expires
+
+
+def revoke_refresh_token(db: Session, token: str):
+    stored = db.query(DbRefreshToken).filter(DbRefreshToken.token_hash == _digest(token)).first()
+    if not stored:
+        raise _invalid()
+    stored.revoked = True
+    db.commit()
+    return "Refresh token revoked"
@@ -1,55 +1,131 @@
+from sqlalchemy import insert, select, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.session import Session
-from schemas import UserBase
+from schemas import UserBase, UserDisplay
 from db.models import DbUser
-from db.hash import Hash
+from db.db_token import revoke_statement
+from db.cache import forget_user, user_cache
+from db.loading import eager_options
+from db.pagination import DEFAULT_LIMIT, keyset, page
 from fastapi import HTTPException, status
 
-def create_user(db: Session, request: UserBase):
+def username_taken(username: str):
+    return HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Username {username} is taken")
+
+
+# the password is hashed by the caller, with Hash.bcrypt_async, rather than on the thread this runs on
+def create_user(db: Session, request: UserBase, hashed_password: str):
     # dont need id as this is auto generated as primary key in models.py
     new_user = DbUser(
         username=request.username,
         email=request.email,
-        password=Hash.bcrypt(request.password)
+        password=hashed_password
     )
     db.add(new_user)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise username_taken(request.username)
     # need to refresh because of id being primary key which is auto created for us.
     db.refresh(new_user)
-    return new_user
+    # built here, the route is async and mustn't lazy load the articles on the event loop
+    return UserDisplay.from_orm(new_user)
 
-def get_all_users(db: Session):
-    all_users = db.query(DbUser).all()
-    if not all_users:
+# display is the response model the users are serialized into, its relationships are loaded eagerly
+def get_all_users(db: Session, limit: int = DEFAULT_LIMIT, after: str = None, display=UserDisplay):
+    statement = keyset(select(DbUser).options(*eager_options(DbUser, display)), DbUser.id, limit, after)
+    all_users = db.execute(statement).scalars().all()
+    if not all_users and after is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"No users found!")
-    return db.query(DbUser).all()
+    return page(all_users, 'id', limit)
+
+
+# every user, fetched from sqlite batch_size rows at a time rather than all at once
+def iter_users(db: Session, batch_size: int, display=UserDisplay):
+    statement = select(DbUser).options(*eager_options(DbUser, display)).order_by(DbUser.id)
+    return db.execute(statement.execution_options(yield_per=batch_size)).scalars()
 
 
+# read through user_cache, so this returns a UserDisplay rather than the DbUser row
 def get_one_user(id: int, db: Session):
-    user = db.query(DbUser).filter(DbUser.id == id).first()
-    if not user:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User with id: {id} not found")
-    return user
+    def load():
+        user = db.query(DbUser).options(*eager_options(DbUser, UserDisplay)).filter(DbUser.id == id).first()
+        if not user:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User with id: {id} not found")
+        return UserDisplay.from_orm(user)
+    return user_cache.get_or_load(id, load)
 
 
-def update_user(request: UserBase, db: Session, id: int):
-    user = db.query(DbUser).filter(DbUser.id == id)
-    if not user.first():
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User with id: {id} not found")
-    user.update({
-        DbUser.username: request.username,
-        DbUser.email: request.email,
-        DbUser.password: Hash.bcrypt(request.password)
-    })
+def taken_usernames(db: Session, usernames: list):
+    return set(db.execute(select(DbUser.username).filter(DbUser.username.in_(usernames))).scalars())
+
+
+def existing_ids(db: Session, ids: set):
+    return set(db.execute(select(DbUser.id).filter(DbUser.id.in_(ids))).scalars())
+
+
+# rows are dicts of username, email and the already hashed password, with no username twice. returns the new
+# ids in the order of rows, None for a username that is taken.
+# the usernames are checked again under the write lock (the caller's check was before seconds of hashing),
+# then one executemany and one select for the ids (sqlite has no RETURNING here), all in one transaction.
+def create_users(db: Session, rows: list):
+    db.execute(text('BEGIN IMMEDIATE'))
+    try:
+        taken = taken_usernames(db, [row['username'] for row in rows])
+        new = [row for row in rows if row['username'] not in taken]
+        if new:
+            db.execute(insert(DbUser), new)
+        ids = dict(db.execute(select(DbUser.username, DbUser.id)
+                              .filter(DbUser.username.in_([row['username'] for row in new]))).all())
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return _create_users_one_by_one(db, rows)
+    return [ids.get(row['username']) for row in rows]
+
+
+def _create_users_one_by_one(db: Session, rows: list):
+    # only the rows that clash fail
+    db.execute(text('BEGIN IMMEDIATE'))
+    ids = []
+    for row in rows:
+        result = db.execute(insert(DbUser).prefix_with('OR IGNORE'), row)
+        ids.append(result.lastrowid if result.rowcount else None)
     db.commit()
-    return db.query(DbUser).filter(DbUser.id == id).first()
+    return ids
+
+
+def update_user(request: UserBase, db: Session, id: int, hashed_password: str):
+    user = db.query(DbUser).options(*eager_options(DbUser, UserDisplay)).filter(DbUser.id == id).first()
+    if not user:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User with id: {id} not found")
+    old_username = user.username
+    user.username = request.username
+    user.email = request.email
+    user.password = hashed_password
+    # the password may have changed, so sign the user out everywhere
+    db.execute(revoke_statement(id))
+    # built before the commit expires the row, rather than selecting it all again afterwards
+    display = UserDisplay.from_orm(user)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise username_taken(request.username)
+    forget_user(id, old_username, request.username)
+    return display
 
 
 def delete_user(db: Session, id: int):
     user = db.query(DbUser).filter(DbUser.id == id).first()
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User with id: {id} not found")
+    username = user.username
+    db.execute(revoke_statement(id))
     db.delete(user)
     db.commit()
+    forget_user(id, username)
     return f"User with id: {id} has been deleted!"
 
 
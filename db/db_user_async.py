@@ -0,0 +1,94 @@
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from schemas import UserBase, UserDisplay
+from db.models import DbUser
+from db.hash import Hash
+from db.db_token import revoke_statement
+from db.db_user import username_taken
+from db.cache import forget_user, user_cache
+from db.loading import eager_options
+from db.pagination import DEFAULT_LIMIT, keyset, page
+from fastapi import HTTPException, status
+
+# async versions of db_user.
+# an AsyncSession can't lazy load, so everything the response model (display) serializes is loaded up front.
+
+
+async def _get_user(db: AsyncSession, id: int, display=UserDisplay):
+    result = await db.execute(select(DbUser).options(*eager_options(DbUser, display)).filter(DbUser.id == id))
+    user = result.scalars().first()
+    if not user:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User with id: {id} not found")
+    return user
+
+
+async def create_user(db: AsyncSession, request: UserBase):
+    new_user = DbUser(
+        username=request.username,
+        email=request.email,
+        password=await Hash.bcrypt_async(request.password),
+        items=[]
+    )
+    db.add(new_user)
+    # id is populated by the flush, expire_on_commit=False means no refresh is needed.
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise username_taken(request.username)
+    return new_user
+
+
+async def get_all_users(db: AsyncSession, limit: int = DEFAULT_LIMIT, after: str = None, display=UserDisplay):
+    statement = keyset(select(DbUser).options(*eager_options(DbUser, display)), DbUser.id, limit, after)
+    result = await db.execute(statement)
+    all_users = result.scalars().all()
+    if not all_users and after is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"No users found!")
+    return page(all_users, 'id', limit)
+
+
+# read through user_cache, so this returns a UserDisplay rather than the DbUser row
+async def get_one_user(id: int, db: AsyncSession):
+    # a miss is loaded on a session of the cache's, not db, see LRUCache.aget_or_load
+    async def load(db: AsyncSession):
+        return UserDisplay.from_orm(await _get_user(db, id))
+    return await user_cache.aget_or_load(id, load)
+
+
+async def update_user(request: UserBase, db: AsyncSession, id: int):
+    user = await _get_user(db, id)
+    old_username = user.username
+    user.username = request.username
+    user.email = request.email
+    user.password = await Hash.bcrypt_async(request.password)
+    # the password may have changed, so sign the user out everywhere
+    await db.execute(revoke_statement(id))
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise username_taken(request.username)
+    forget_user(id, old_username, request.username)
+    return user
+
+
+async def delete_user(db: AsyncSession, id: int):
+    result = await db.execute(select(DbUser).filter(DbUser.id == id))
+    user = result.scalars().first()
+    if not user:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User with id: {id} not found")
+    await db.execute(revoke_statement(id))
+    await db.delete(user)
+    await db.commit()
+    forget_user(id, user.username)
+    return f"User with id: {id} has been deleted!"
+
+
+async def get_user_by_username(db: AsyncSession, username: str):
+    result = await db.execute(select(DbUser).filter(DbUser.username == username))
+    user = result.scalars().first()
+    if not user:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User with username: {username} not found")
+    return user
@@ -1,10 +1,149 @@
-from passlib.context import CryptContext
+import asyncio
+import math
+import multiprocessing
+import os
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+
+from starlette.concurrency import run_in_threadpool
+
+from settings import HASH_WORKERS, BCRYPT_ROUNDS, BCRYPT_TARGET_MS
+
+# calibrate() never goes below MIN_ROUNDS, however slow the machine
+MIN_ROUNDS = 10
+MAX_ROUNDS = 18
+# bcrypt_many_async sends the passwords to the workers this many at a time
+HASH_CHUNK = 4
+
+rounds = BCRYPT_ROUNDS or 12
+# settled, by BCRYPT_ROUNDS or by serve.py calibrating once for all of its workers, calibrate() keeps it
+pinned = bool(BCRYPT_ROUNDS)
+# processes in the pool
+workers = HASH_WORKERS
+# passlib is slow to import, so it's only imported (and the context made) once a password is checked
+_context = None
+
+# bcrypt holds the gil for ~250ms a call, so it runs in worker processes rather than on the request's thread.
+# spawn rather than fork, the app has threads running by the time the pool starts.
+_executor = None
+# chunks bcrypt_many_async has queued on the pool, shared by every bulk request. by event loop, as a semaphore
+# can only be waited on from one (there's one per worker, but the test client runs a loop per request)
+_batch_slots = weakref.WeakKeyDictionary()
+
+
+def _crypt_context():
+    global _context
+    if _context is None:
+        from passlib.context import CryptContext
+        _context = CryptContext(schemes="bcrypt", deprecated="auto", bcrypt__min_rounds=rounds)
+    return _context
+
+
+def _hash(password: str, cost: int):
+    from passlib.hash import bcrypt as bcrypt_handler
+    return bcrypt_handler.using(rounds=cost).hash(password)
+
+
+def _hash_many(passwords: list, cost: int):
+    from passlib.hash import bcrypt as bcrypt_handler
+    # using() makes a new handler class, once for the chunk rather than for every password
+    handler = bcrypt_handler.using(rounds=cost)
+    return [handler.hash(password) for password in passwords]
+
+
+def _verify(hashed_password: str, plain_password: str):
+    from passlib.hash import bcrypt as bcrypt_handler
+    return bcrypt_handler.verify(plain_password, hashed_password)
+
+
+def _get_batch_slots():
+    loop = asyncio.get_running_loop()
+    slots = _batch_slots.get(loop)
+    if slots is None:
+        slots = _batch_slots[loop] = asyncio.Semaphore(workers)
+    return slots
+
+
+def _get_executor():
+    global _executor
+    if _executor is None and workers > 0:
+        _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+
+def set_rounds(cost: int):
+    """hash new passwords with cost, and mark anything weaker as needing an update."""
+    global rounds, _context
+    rounds = cost
+    _context = None
+
+
+def prepare_for_workers(processes: int):
+    """
+    called by serve.py before it forks. calibrates once for all the workers, which would otherwise calibrate at
+    the same time, competing for the cpu and maybe settling on different costs. unless HASH_WORKERS is set, the
+    cores are shared out between the workers' pools rather than every worker starting min(4, cpus) processes.
+    """
+    global pinned, workers
+    Hash.calibrate(start_pool=False)
+    pinned = True
+    if 'HASH_WORKERS' not in os.environ:
+        workers = max(1, (os.cpu_count() or 1) // processes)
 
-pwd_cxt = CryptContext(schemes="bcrypt", deprecated="auto")
 
 class Hash:
-    def bcrypt(password: str):
-        return pwd_cxt.hash(password)
+    # async only: a sync wrapper would hold its thread for the whole hash, waiting on the pool
+    async def bcrypt_async(password: str):
+        executor = _get_executor()
+        if executor is None:
+            return await run_in_threadpool(_hash, password, rounds)
+        return await asyncio.wrap_future(executor.submit(_hash, password, rounds))
+
+    async def bcrypt_many_async(passwords: list):
+        """
+        hashes the passwords on every worker process at once. only one chunk per worker is queued at a time,
+        however many bulk requests are hashing, so a login waits behind at most a chunk rather than behind them.
+        """
+        executor = _get_executor()
+        if executor is None:
+            return await run_in_threadpool(_hash_many, passwords, rounds)
+        slots = _get_batch_slots()
+
+        async def hash_chunk(chunk):
+            async with slots:
+                return await asyncio.wrap_future(executor.submit(_hash_many, chunk, rounds))
+        chunks = await asyncio.gather(*(hash_chunk(passwords[i:i + HASH_CHUNK])
+                                        for i in range(0, len(passwords), HASH_CHUNK)))
+        return [hashed for chunk in chunks for hashed in chunk]
+
+    async def verify_async(hashed_password, plain_password):
+        executor = _get_executor()
+        if executor is None:
+            return await run_in_threadpool(_verify, hashed_password, plain_password)
+        return await asyncio.wrap_future(executor.submit(_verify, hashed_password, plain_password))
+
+    def needs_update(hashed_password):
+        # true when the hash was made with a lower cost than the current one
+        return _crypt_context().needs_update(hashed_password)
+
+    def calibrate(target_ms: float = BCRYPT_TARGET_MS, start_pool: bool = True):
+        """pick the bcrypt cost that takes about target_ms on this machine, unless it's pinned."""
+        if not pinned:
+            start = time.perf_counter()
+            _hash('calibration', MIN_ROUNDS)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            # every extra round doubles the work
+            cost = MIN_ROUNDS + round(math.log2(target_ms / elapsed_ms))
+            set_rounds(max(MIN_ROUNDS, min(MAX_ROUNDS, cost)))
+        # start the worker processes now rather than on the first login
+        executor = _get_executor() if start_pool else None
+        if executor is not None:
+            list(executor.map(abs, range(workers)))
+        return rounds
 
-    def verify(hashed_password, plain_password):
-        return pwd_cxt.verify(plain_password, hashed_password)
\ No newline at end of file
+    def shutdown():
+        global _executor
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
@@ -0,0 +1,125 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+from logs.logging import log
+from settings import SLOW_QUERY_MS, QUERY_DEBUG
+
+# every statement on the engines is timed. the time is added to the stats of the request that ran it, found
+# through a context variable (sync routes and dependencies get a copy of the request's context on the
+# threadpool, so they add to the same stats), and to any query_budget() watching.
+
+# statements kept per request, slowest first
+SLOWEST = 3
+
+
+class QueryStats:
+    def __init__(self, path: str = None):
+        self.path = path
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = []
+
+    def record(self, statement: str, seconds: float):
+        self.count += 1
+        self.seconds += seconds
+        if len(self.slowest) < SLOWEST or seconds > self.slowest[-1][0]:
+            self.slowest.append((seconds, statement))
+            self.slowest.sort(key=lambda entry: entry[0], reverse=True)
+            del self.slowest[SLOWEST:]
+
+    def headers(self):
+        headers = [
+            (b'x-db-query-count', str(self.count).encode()),
+            (b'x-db-time-ms', f'{self.seconds * 1000:.2f}'.encode()),
+        ]
+        if self.slowest:
+            seconds, statement = self.slowest[0]
+            # one line, and short enough for a header
+            statement = ' '.join(statement.split())[:200]
+            headers.append((b'x-db-slowest', f'{seconds * 1000:.2f}ms {statement}'.encode('latin-1', 'replace')))
+        return headers
+
+
+class BudgetStats(QueryStats):
+    """keeps every statement, for the message when a budget is blown."""
+    def __init__(self):
+        super().__init__()
+        self.statements = []
+
+    def record(self, statement: str, seconds: float):
+        super().record(statement, seconds)
+        self.statements.append(statement)
+
+
+_current = ContextVar('query_stats', default=None)
+_budgets = []
+
+
+def _before(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['query_start'].pop()
+    stats = _current.get()
+    if stats is not None:
+        stats.record(statement, seconds)
+    for budget in _budgets:
+        budget.record(statement, seconds)
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        path = stats.path if stats is not None else '-'
+        log('slow-query', f'{seconds * 1000:.1f}ms {path} {" ".join(statement.split())}')
+
+
+def _failed(context):
+    # after_cursor_execute doesn't run for a statement that raised
+    starts = context.connection.info.get('query_start')
+    if starts:
+        starts.pop()
+
+
+def instrument(bind):
+    event.listen(bind, 'before_cursor_execute', _before)
+    event.listen(bind, 'after_cursor_execute', _after)
+    event.listen(bind, 'handle_error', _failed)
+
+
+@contextmanager
+def query_budget(max_queries: int):
+    """fail when the block runs more than max_queries statements, on any engine and in any thread."""
+    stats = BudgetStats()
+    _budgets.append(stats)
+    try:
+        yield stats
+    finally:
+        _budgets.remove(stats)
+    if stats.count > max_queries:
+        raise AssertionError(f'{stats.count} queries, the budget is {max_queries}:\n' + '\n'.join(stats.statements))
+
+
+class QueryStatsMiddleware:
+    """collects the queries of each request, and with QUERY_DEBUG reports them in the response headers."""
+    def __init__(self, app, headers: bool = QUERY_DEBUG):
+        self.app = app
+        self.headers = headers
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        # an outer instance (a test wrapping the app) already collects them
+        stats = _current.get() or QueryStats(scope['path'])
+
+        async def send_with_stats(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = list(message.get('headers', [])) + stats.headers()
+            await send(message)
+
+        token = _current.set(stats)
+        try:
+            await self.app(scope, receive, send_with_stats if self.headers else send)
+        finally:
+            _current.reset(token)
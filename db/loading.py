@@ -0,0 +1,39 @@
+from functools import lru_cache
+from pydantic import BaseModel
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, selectinload
+
+
+def eager_options(model, schema):
+    """
+    loader options for every relationship of the orm model that the response schema serializes,
+    so building the response doesn't lazy load one row at a time (N+1 queries).
+    collections use selectinload (one extra query for all parents), many-to-one uses joinedload.
+    """
+    return _eager_options(model, schema)
+
+
+@lru_cache(maxsize=None)
+def _eager_options(model, schema):
+    return tuple(_loaders(model, schema, None))
+
+
+def _loaders(model, schema, parent):
+    relationships = inspect(model).relationships
+    loaders = []
+    for name, field in schema.__fields__.items():
+        if name not in relationships:
+            continue
+        relationship = relationships[name]
+        attribute = getattr(model, name)
+        if relationship.uselist:
+            loader = parent.selectinload(attribute) if parent else selectinload(attribute)
+        else:
+            loader = parent.joinedload(attribute) if parent else joinedload(attribute)
+        # List[Article] and Article both show up as field.type_ == Article.
+        # chained loaders carry their parent path, so they replace the parent loader when present.
+        nested = []
+        if isinstance(field.type_, type) and issubclass(field.type_, BaseModel):
+            nested = _loaders(relationship.mapper.class_, field.type_, loader)
+        loaders.extend(nested or [loader])
+    return loaders
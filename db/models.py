@@ -1,14 +1,15 @@
 from db.database import Base
 from sqlalchemy import Column
-from sqlalchemy.sql.sqltypes import Integer, String, Boolean
+from sqlalchemy.sql.sqltypes import Integer, String, Boolean, DateTime
 from sqlalchemy.sql.schema import ForeignKey
 from sqlalchemy.orm import relationship
 
 class DbUser(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True, index=True)
-    username = Column(String)
-    email = Column(String)
+    # unique, so two requests can't both create (or rename to) the same username
+    username = Column(String, unique=True, index=True)
+    email = Column(String, index=True)
     password = Column(String)
     items = relationship("DbArticle", back_populates="user")
 
@@ -18,5 +19,43 @@ class DbArticle(Base):
     title = Column(String)
     content = Column(String)
     published = Column(Boolean)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     user = relationship("DbUser", back_populates="items")
+
+class DbRefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+    id = Column(Integer, primary_key=True, index=True)
+    # sha256 of the token, the token itself is only ever held by the client
+    token_hash = Column(String, unique=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    expires_at = Column(DateTime)
+    revoked = Column(Boolean, default=False)
+    user = relationship("DbUser")
+
+class DbJob(Base):
+    __tablename__ = "jobs"
+    # uuid hex, handed to the client before the job has run
+    id = Column(String, primary_key=True)
+    name = Column(String)
+    # json
+    params = Column(String)
+    status = Column(String, index=True)
+    result = Column(String)
+    error = Column(String)
+    created_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    # the worker running the job, which keeps pushing lease_until on while it does. a running job whose
+    # lease has run out was cut off, and can be claimed by another worker
+    owner = Column(String)
+    lease_until = Column(DateTime)
+
+class DbProduct(Base):
+    __tablename__ = "products"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String)
+
+class DbCatalogVersion(Base):
+    # a single row, bumped with every product write so each worker knows when its cached catalog is stale
+    __tablename__ = "catalog_version"
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, default=0)
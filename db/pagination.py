@@ -0,0 +1,34 @@
+import base64
+import binascii
+from fastapi import HTTPException, status
+
+# keyset (cursor) pagination: a page is "WHERE key > :after ORDER BY key LIMIT :limit",
+# which walks the primary key index so page 10,000 costs the same as page 1 (unlike OFFSET).
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+
+def encode_cursor(key: int) -> str:
+    # opaque to clients, they only ever hand it back to us
+    return base64.urlsafe_b64encode(str(key).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid cursor: {cursor}")
+
+
+def keyset(statement, key, limit: int, after: str = None):
+    """limit the select to the page after the cursor, fetching one extra row to see if there is a next page."""
+    if after is not None:
+        statement = statement.filter(key > decode_cursor(after))
+    return statement.order_by(key).limit(limit + 1)
+
+
+def page(rows, key: str, limit: int):
+    """build the response for rows fetched with keyset()."""
+    next_cursor = encode_cursor(getattr(rows[limit - 1], key)) if len(rows) > limit else None
+    return {'items': rows[:limit], 'next_cursor': next_cursor}
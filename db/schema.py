@@ -0,0 +1,20 @@
+from db import models
+from db.database import engine, add_missing_columns, create_missing_indexes
+from db.db_product import seed_products
+from db.search import create_search_index
+
+# set once the schema is known to be in place, a forked worker inherits it and skips the work
+initialized = False
+
+
+def init_db(bind=engine):
+    """create the tables, indexes and search index that are missing, and seed the product catalog."""
+    global initialized
+    if initialized:
+        return
+    models.Base.metadata.create_all(bind)
+    add_missing_columns(bind)
+    create_missing_indexes(bind)
+    create_search_index(bind)
+    seed_products(bind)
+    initialized = True
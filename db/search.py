@@ -0,0 +1,61 @@
+from sqlalchemy import text
+from sqlalchemy.orm.session import Session
+from fastapi import HTTPException, status
+from db.models import DbArticle
+from db.loading import eager_options
+from schemas import ArticleDisplay
+
+# full text search over articles.title/content with an sqlite FTS5 external content table.
+# the triggers keep it in step with every insert, update and delete on articles.
+
+FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS articles_fts
+       USING fts5(title, content, content='articles', content_rowid='id')""",
+    """CREATE TRIGGER IF NOT EXISTS articles_fts_insert AFTER INSERT ON articles BEGIN
+         INSERT INTO articles_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS articles_fts_delete AFTER DELETE ON articles BEGIN
+         INSERT INTO articles_fts(articles_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS articles_fts_update AFTER UPDATE ON articles BEGIN
+         INSERT INTO articles_fts(articles_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+         INSERT INTO articles_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+       END""",
+]
+
+
+def create_search_index(bind):
+    with bind.begin() as connection:
+        exists = connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'articles_fts'")).first()
+        for ddl in FTS_DDL:
+            connection.execute(text(ddl))
+        if not exists:
+            # index the articles written before the search table existed
+            connection.execute(text("INSERT INTO articles_fts(articles_fts) VALUES ('rebuild')"))
+
+
+def match_query(q: str):
+    # quote every term so user input is matched as words rather than parsed as FTS5 syntax
+    terms = ['"' + term.replace('"', '""') + '"' for term in q.split()]
+    if not terms:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Search query is empty")
+    return ' '.join(terms)
+
+
+def search_articles(db: Session, q: str, limit: int, offset: int = 0, display=ArticleDisplay):
+    hits = db.execute(
+        text("""SELECT rowid, snippet(articles_fts, -1, '<b>', '</b>', '...', 12)
+                FROM articles_fts WHERE articles_fts MATCH :q
+                ORDER BY rank LIMIT :limit OFFSET :offset"""),
+        {'q': match_query(q), 'limit': limit + 1, 'offset': offset}
+    ).all()
+    more = len(hits) > limit
+    hits = hits[:limit]
+
+    articles = db.query(DbArticle).options(*eager_options(DbArticle, display)) \
+        .filter(DbArticle.id.in_([id for id, _ in hits])).all()
+    by_id = {article.id: article for article in articles}
+    return {
+        'items': [{'article': by_id[id], 'snippet': snippet} for id, snippet in hits if id in by_id],
+        'next_offset': offset + limit if more else None
+    }
@@ -0,0 +1,199 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from db import db_job
+from db.database import SessionLocal
+from db.db_job import QUEUED, RUNNING, DONE, FAILED
+from schemas import JobDisplay
+from settings import JOB_BACKEND, JOB_KEEP_FINISHED, JOB_LEASE_SECONDS, JOB_WORKERS
+
+# blocking work is submitted here by name and runs on a pool of threads, so the event loop keeps serving
+# other requests meanwhile. the caller gets a job id straight away and can poll or await the result.
+
+tasks = {}
+
+
+def task(name: str):
+    """register a function that jobs can run, params and result must be json serialisable."""
+    def register(function):
+        tasks[name] = function
+        return function
+    return register
+
+
+class MemoryStore:
+    """jobs are lost on restart, and finished ones once there are more than keep_finished of them."""
+    def __init__(self, keep_finished: int = JOB_KEEP_FINISHED):
+        self.jobs = {}
+        # ids of the finished jobs, oldest first
+        self.finished = OrderedDict()
+        self.keep_finished = keep_finished
+        self.lock = threading.Lock()
+
+    def create(self, id: str, name: str, params: dict):
+        with self.lock:
+            self.jobs[id] = JobDisplay(id=id, name=name, status=QUEUED)
+
+    def claim(self, id: str):
+        # only ever run by the process that made it
+        self.update(id, RUNNING)
+        return True
+
+    def update(self, id: str, status: str, result=None, error: str = None):
+        with self.lock:
+            self.jobs[id] = self.jobs[id].copy(update={'status': status, 'result': result, 'error': error})
+            if status in (DONE, FAILED):
+                self.finished[id] = None
+                while len(self.finished) > self.keep_finished:
+                    oldest, _ = self.finished.popitem(last=False)
+                    del self.jobs[oldest]
+
+    def get(self, id: str):
+        return self.jobs.get(id)
+
+    def unfinished(self):
+        return []
+
+
+class DatabaseStore:
+    """
+    jobs are rows in the jobs table, queued and interrupted ones are run again by resume(). every worker
+    resumes at startup, so a job is claimed before it's run, and the claim is renewed while it runs: only a
+    job whose worker has gone (its lease ran out) is taken over.
+    """
+    def __init__(self, lease_seconds: float = JOB_LEASE_SECONDS):
+        self.lease_seconds = lease_seconds
+        self.running = set()
+        self.lock = threading.Lock()
+        self.renewer = None
+
+    @property
+    def owner(self):
+        # looked up every time, a forked worker mustn't pass for its parent
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def create(self, id: str, name: str, params: dict):
+        with SessionLocal() as db:
+            db_job.create_job(db, id, name, params)
+
+    def claim(self, id: str):
+        with SessionLocal() as db:
+            if not db_job.claim_job(db, id, self.owner, self.lease_seconds):
+                return False
+        with self.lock:
+            self.running.add(id)
+            if self.renewer is None:
+                self.renewer = threading.Thread(target=self.renew, name='job-leases', daemon=True)
+                self.renewer.start()
+        return True
+
+    def renew(self):
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            with self.lock:
+                ids = list(self.running)
+                if not ids:
+                    self.renewer = None
+                    return
+            try:
+                with SessionLocal() as db:
+                    db_job.renew_leases(db, ids, self.owner, self.lease_seconds)
+            except SQLAlchemyError:
+                # tried again next time round, the lease has a couple of rounds left
+                pass
+
+    def update(self, id: str, status: str, result=None, error: str = None):
+        with SessionLocal() as db:
+            db_job.update_job(db, id, self.owner, status, result, error)
+        if status in (DONE, FAILED):
+            with self.lock:
+                self.running.discard(id)
+
+    def get(self, id: str):
+        with SessionLocal() as db:
+            return db_job.get_job(db, id)
+
+    def unfinished(self):
+        with SessionLocal() as db:
+            return db_job.get_unfinished_jobs(db)
+
+
+class JobQueue:
+    def __init__(self, store, workers: int = JOB_WORKERS):
+        self.store = store
+        self.workers = workers
+        self.executor = None
+        # completion of the jobs started by this process, for wait()
+        self.futures = {}
+
+    def _get_executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job')
+        return self.executor
+
+    def _schedule(self, id: str, name: str, params: dict):
+        done = self.futures[id] = Future()
+        self._get_executor().submit(self._run, id, name, params, done)
+
+    def _run(self, id: str, name: str, params: dict, done: Future):
+        try:
+            if not self.store.claim(id):
+                # already running on another worker
+                return
+            result = tasks[name](**params)
+        except Exception as error:
+            self.store.update(id, FAILED, error=repr(error))
+        else:
+            self.store.update(id, DONE, result)
+        finally:
+            del self.futures[id]
+            done.set_result(None)
+
+    def submit(self, name: str, **params):
+        if name not in tasks:
+            raise KeyError(f"Unknown job: {name}")
+        id = uuid.uuid4().hex
+        self.store.create(id, name, params)
+        self._schedule(id, name, params)
+        return id
+
+    def get(self, id: str):
+        return self.store.get(id)
+
+    async def wait(self, id: str, timeout: float = None):
+        """the job once it has finished, or as it stands after timeout seconds."""
+        done = self.futures.get(id)
+        if done is not None:
+            try:
+                # shielded, giving up on waiting mustn't cancel the job
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(done)), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.store.get(id)
+
+    def resume(self):
+        """queue again the jobs a previous run of the app didn't finish, the ones still running elsewhere are skipped."""
+        for id, name, params in self.store.unfinished():
+            if id not in self.futures and name in tasks:
+                self._schedule(id, name, params)
+
+    def shutdown(self, wait: bool = True):
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait, cancel_futures=not wait)
+            self.executor = None
+
+
+def make_queue():
+    store = {'memory': MemoryStore, 'database': DatabaseStore}[JOB_BACKEND]()
+    return JobQueue(store)
+
+
+jobs = make_queue()
@@ -1,6 +1,202 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
 from fastapi.requests import Request
 
+from settings import (LOG_PATH, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL_MS, LOG_MAX_BYTES, LOG_BACKUPS,
+                      LOG_QUEUE_SIZE, LOG_FULL_POLICY)
+
+DROP = "drop"
+BLOCK = "block"
+# tells the writer to finish up
+_STOP = object()
+
+
+class RotationLock:
+    """
+    flock on <path>.lock, shared while appending and exclusive while rotating. fcntl is unix only, without it
+    (windows, where serve.py's forked workers don't run either) the lock only covers this process.
+    """
+    def __init__(self, path: str):
+        try:
+            import fcntl
+        except ImportError:
+            fcntl = None
+        self.fcntl = fcntl
+        self.local = threading.Lock()
+        self.file = open(path, 'a') if fcntl is not None else None
+
+    @contextmanager
+    def hold(self, exclusive: bool = False):
+        with self.local:
+            if self.fcntl is None:
+                yield
+                return
+            self.fcntl.flock(self.file, self.fcntl.LOCK_EX if exclusive else self.fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                self.fcntl.flock(self.file, self.fcntl.LOCK_UN)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class LogSink:
+    """
+    queue backed log file. emit() only puts the record on the queue, a writer thread formats the records
+    and appends them in batches, so a request never waits on the file.
+    every worker of serve.py has its own sink on the same file. a batch is appended while holding a shared
+    flock on <path>.lock and rotating takes it exclusively, so no worker writes to a file that another one is
+    renaming, and a worker that finds the file has been rotated under it reopens it.
+    """
+    def __init__(self, path: str = LOG_PATH, batch_size: int = LOG_BATCH_SIZE,
+                 flush_interval_ms: float = LOG_FLUSH_INTERVAL_MS, max_bytes: int = LOG_MAX_BYTES,
+                 backups: int = LOG_BACKUPS, queue_size: int = LOG_QUEUE_SIZE, policy: str = LOG_FULL_POLICY):
+        if policy not in (DROP, BLOCK):
+            raise ValueError(f"Unknown log full policy: {policy}")
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.policy = policy
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.writer = None
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+
+    def emit(self, record: dict):
+        if self.writer is None:
+            self.start()
+        if self.policy == BLOCK:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.run, name='log-writer', daemon=True)
+                self.writer.start()
+
+    def close(self):
+        """write out everything queued and stop the writer."""
+        with self.lock:
+            writer, self.writer = self.writer, None
+        if writer is not None:
+            self.queue.put(_STOP)
+            writer.join()
+
+    def open_file(self):
+        # unbuffered, so a batch goes out in one append and lines of different workers don't interleave
+        return open(self.path, 'ab', buffering=0)
+
+    def current(self, file):
+        """file, or the file at path when another worker has rotated file away."""
+        try:
+            rotated = os.stat(self.path).st_ino != os.fstat(file.fileno()).st_ino
+        except FileNotFoundError:
+            rotated = True
+        if not rotated:
+            return file
+        file.close()
+        return self.open_file()
+
+    def run(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # opened here rather than in __init__, a forked worker must not share its parent's lock
+        lock = RotationLock(self.path + '.lock')
+        file = self.open_file()
+        try:
+            stopping = False
+            while not stopping:
+                try:
+                    batch = [self.queue.get(timeout=self.flush_interval)]
+                except queue.Empty:
+                    continue
+                # whatever else is already waiting, up to a batch
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if any(record is _STOP for record in batch):
+                    batch = [record for record in batch if record is not _STOP]
+                    stopping = True
+                if not batch:
+                    continue
+                data = ''.join(json.dumps(record, default=str) + '\n' for record in batch).encode('utf-8')
+                with lock.hold():
+                    file = self.current(file)
+                    file.write(data)
+                    size = os.fstat(file.fileno()).st_size
+                self.written += len(batch)
+                if size >= self.max_bytes:
+                    with lock.hold(exclusive=True):
+                        # closed first, windows won't rename a file that is open
+                        file.close()
+                        # unless another worker got here first
+                        if os.path.exists(self.path) and os.stat(self.path).st_size >= self.max_bytes:
+                            self.rotate()
+                        file = self.open_file()
+        finally:
+            file.close()
+            lock.close()
+
+    def rotate(self):
+        # log.txt -> log.txt.1 -> ... -> log.txt.<backups>, the oldest is dropped
+        for index in range(self.backups - 1, 0, -1):
+            older = f'{self.path}.{index}'
+            if os.path.exists(older):
+                os.replace(older, f'{self.path}.{index + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'rotations': self.rotations,
+        }
+
+
+sink = LogSink()
+# the shutdown event closes it too, this covers scripts and tests that never start the app
+atexit.register(sink.close)
+
+
+def _reset_after_fork():
+    # the writer thread doesn't survive a fork (see serve.py), the worker starts its own with an empty queue
+    sink.writer = None
+    sink.lock = threading.Lock()
+    sink.queue = queue.Queue(maxsize=sink.queue.maxsize)
+
+
+# windows has no fork, nor os.register_at_fork
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
 def log(tag='MyApp', message='no message', request: Request = None):
-    with open('logs/log.txt', 'a+') as log:
-        log.write(f'{tag}: {message}\n')
-        log.write(f'\t{request.url}\n')
+    sink.emit({
+        'time': time.time(),
+        'tag': tag,
+        'message': message,
+        'url': str(request.url) if request is not None else None,
+    })
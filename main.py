@@ -2,81 +2,175 @@
 This is the main file where the app will be running
 """
 
-import uvicorn
+import importlib
 import os
+from typing import Optional
 
 from fastapi import FastAPI
-from router import blog_get, blog_posts, user, article, product, file, dependencies
-from auth import authentication
-from db import models
-from db.database import engine
+from settings import DB_ASYNC
+from db.hash import Hash
+from db.schema import init_db
 from exceptions import EmailException
-from templates import templates
 from fastapi import Request
 from fastapi.responses import JSONResponse, HTMLResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from client import html
-from fastapi.websockets import WebSocket
+from fastapi.websockets import WebSocket, WebSocketDisconnect
+from chat.hub import hub
+from chat.pubsub import pubsub
+from jobs.queue import jobs
+from logs.logging import sink
+from metrics.middleware import MetricsMiddleware
+from metrics import profiler
+from db.instrumentation import QueryStatsMiddleware
+from metrics.registry import start_flushing, stop_flushing
+from serialization import response_class
 
-app = FastAPI()
-app.include_router(dependencies.router)
-app.include_router(templates.router)
-app.include_router(authentication.router)
-app.include_router(blog_get.router)
-app.include_router(blog_posts.router)
-app.include_router(user.router)
-app.include_router(article.router)
-app.include_router(product.router)
-app.include_router(file.router)
+# routers are imported by create_app, in this order. a pair is (sync, async) and DB_ASYNC picks which one,
+# the other isn't imported at all
+ROUTERS = [
+    'router.dependencies',
+    'templates.templates',
+    ('auth.authentication', 'auth.authentication_async'),
+    'auth.refresh',
+    'router.blog_get',
+    'router.blog_posts',
+    'router.export',
+    'router.bulk',
+    ('router.user', 'router.user_async'),
+    'router.search',
+    ('router.article', 'router.article_async'),
+    'router.product',
+    'router.file',
+    'router.monitoring',
+    'router.prometheus',
+]
+
+origins = [
+    'http://localhost:3000'
+]
 
 
-@app.get("/")
 async def get():
     return HTMLResponse(html)
 
 
-clients = []
-
-@app.websocket("/endpoint")
-async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
-    clients.append(websocket)
-    while True:
-        data = await websocket.receive_text()
-        for client in clients:
-            await client.send_text(data)
+# every message is published to the clients in the same room on every worker, see chat/pubsub.py.
+# a client reconnecting with ?last_seen=<seq> first gets the messages it missed, see chat/hub.py
+async def websocket_endpoint(websocket: WebSocket, room: str = 'default', last_seen: Optional[int] = None):
+    connection = await hub.connect(websocket, room, last_seen)
+    try:
+        while True:
+            data = await websocket.receive_text()
+            pubsub.publish(room, data)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        hub.disconnect(connection)
 
 
 # this creates the db, only created when the db doesn't exist already.
-models.Base.metadata.create_all(engine)
+# serve.py does it once before forking the workers, so there it's a no-op.
+def create_db():
+    init_db()
+
+
+def calibrate_hashing():
+    Hash.calibrate()
+
+
+async def start_chat():
+    await pubsub.start()
+
+
+def resume_jobs():
+    jobs.resume()
+
+
+async def start_metrics():
+    start_flushing()
+
+
+def stop_hashing():
+    Hash.shutdown()
+
+
+async def stop_chat():
+    await pubsub.stop()
+
+
+def stop_jobs():
+    # running jobs finish, queued ones are dropped (or picked up by the next start with JOB_BACKEND=database)
+    jobs.shutdown(wait=False)
+
+
+def flush_logs():
+    sink.close()
+
+
+async def flush_metrics():
+    await stop_flushing()
+
 
 # handle custom exceptions in a more user friendly way:
-@app.exception_handler(EmailException)
 def email_exception_handler(request: Request, exc: EmailException):
     return JSONResponse(
         status_code=418,
         content={'detail': exc.message}
     )
 
-origins = [
-    'http://localhost:3000'
-]
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=['*'],
-    allow_headers=['*']
-)
-
-app.mount('/files',
-          StaticFiles(directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'files')),
-          name='files')
-app.mount('/templates/static',
-          StaticFiles(directory='templates/static'),
-          name='static')
+def create_app(db_async: bool = DB_ASYNC):
+    """
+    builds the app. nothing here touches the db or starts a thread or a process, that all happens in the
+    startup hooks, so importing this module is cheap and safe to do before forking (see serve.py).
+    """
+    # orjson unless JSON_RESPONSE=json, see serialization.py
+    app = FastAPI(default_response_class=response_class())
+    for module in ROUTERS:
+        if isinstance(module, tuple):
+            # db_async swaps the db backed routers for their aiosqlite versions
+            module = module[db_async]
+        app.include_router(importlib.import_module(module).router)
+
+    app.add_api_route("/", get, methods=["GET"])
+    app.add_api_websocket_route("/endpoint", websocket_endpoint)
+
+    for hook in (create_db, calibrate_hashing, start_chat, resume_jobs, start_metrics):
+        app.add_event_handler("startup", hook)
+    for hook in (stop_hashing, stop_chat, stop_jobs, flush_logs, flush_metrics):
+        app.add_event_handler("shutdown", hook)
+
+    app.add_exception_handler(EmailException, email_exception_handler)
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=origins,
+        allow_credentials=True,
+        allow_methods=['*'],
+        allow_headers=['*']
+    )
+    # queries per request, for the slow query log and (with QUERY_DEBUG) the X-DB-* headers
+    app.add_middleware(QueryStatsMiddleware)
+    # per route request counts and latencies for /metrics
+    app.add_middleware(MetricsMiddleware)
+    # not even added unless PROFILE_SAMPLE_RATE or PROFILE_TOKEN is set
+    if profiler.enabled():
+        app.add_middleware(profiler.ProfilerMiddleware)
+
+    app.mount('/files',
+              StaticFiles(directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'files')),
+              name='files')
+    app.mount('/templates/static',
+              StaticFiles(directory='templates/static'),
+              name='static')
+    return app
+
+
+app = create_app()
 
 if __name__ == "__main__":
+    # only needed to run it this way, serve.py and `uvicorn main:app` bring their own
+    import uvicorn
     uvicorn.run(app, host="127.0.0.1", port=8000)
@@ -0,0 +1,74 @@
+import time
+
+import anyio
+from starlette.routing import Mount
+
+from metrics.registry import (registry, requests_total, request_duration, requests_in_flight,
+                              threadpool_busy, threadpool_size, threadpool_waiting)
+
+# requests that matched no route share one label, so random 404 paths can't blow up the series count
+UNMATCHED = 'unmatched'
+
+
+class RouteTemplates:
+    """the route template of a handled request, /user/{id} rather than /user/42."""
+    def __init__(self):
+        self.templates = None
+
+    def __call__(self, scope):
+        if self.templates is None and 'app' in scope:
+            # the router leaves the matched endpoint in the scope, map those back to their paths
+            self.templates = {}
+            for route in scope['app'].routes:
+                if isinstance(route, Mount):
+                    self.templates[route.app] = route.path + '/{path}'
+                else:
+                    self.templates[route.endpoint] = route.path
+        return (self.templates or {}).get(scope.get('endpoint'), UNMATCHED)
+
+
+class MetricsMiddleware:
+    """plain asgi middleware (BaseHTTPMiddleware would add a task and a queue per request)."""
+    def __init__(self, app):
+        self.app = app
+        self.route_template = RouteTemplates()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_and_record_status(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            requests_in_flight.dec()
+            route = self.route_template(scope)
+            requests_total.inc((route, scope['method'], str(status_code)))
+            request_duration.observe((route, scope['method']), elapsed)
+
+
+def collect_threadpool():
+    # sync routes and dependencies run on anyio's default limiter, once it's full they queue
+    try:
+        limiter = anyio.to_thread.current_default_thread_limiter()
+    except RuntimeError:
+        # not on the event loop
+        return
+    statistics = limiter.statistics()
+    threadpool_busy.set(value=statistics.borrowed_tokens)
+    threadpool_size.set(value=statistics.total_tokens)
+    threadpool_waiting.set(value=statistics.tasks_waiting)
+
+
+registry.collectors.append(collect_threadpool)
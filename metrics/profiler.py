@@ -0,0 +1,175 @@
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from urllib.parse import quote, unquote
+
+from starlette.concurrency import run_in_threadpool
+
+from metrics.middleware import RouteTemplates
+from settings import (PROFILE_SAMPLE_RATE, PROFILE_TOKEN, PROFILE_INTERVAL_MS, PROFILE_DIR,
+                      PROFILE_MAX_STACKS, PROFILE_MAX_ROUTES)
+
+# sampled profiling of live requests. while a profiled request runs, a sampler thread takes the stack of every
+# busy thread every PROFILE_INTERVAL_MS, so both async handlers on the event loop and sync ones on the
+# threadpool show up. the samples are kept per route in collapsed stack format ("a;b;c 12" per line), which
+# flamegraph.pl and speedscope read as is. other requests running at the same time show up in the samples too.
+
+PROFILE_HEADER = b'x-profile'
+# a thread whose innermost frame is one of these is waiting, not working
+IDLE = {'select', 'poll', 'wait', '_wait_for_tstate_lock', 'accept'}
+
+
+def enabled():
+    return bool(PROFILE_SAMPLE_RATE or PROFILE_TOKEN)
+
+
+def collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Sampler:
+    """one thread samples for every profiled request in flight, and stops when there are none."""
+    def __init__(self, interval_ms: float = PROFILE_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self.lock = threading.Lock()
+        self.active = {}
+        self.thread = None
+
+    def begin(self):
+        samples = Counter()
+        with self.lock:
+            self.active[id(samples)] = samples
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+                self.thread.start()
+        return samples
+
+    def end(self, samples: Counter):
+        with self.lock:
+            del self.active[id(samples)]
+
+    def run(self):
+        me = threading.get_ident()
+        while True:
+            stacks = [collapse(frame) for ident, frame in sys._current_frames().items()
+                      if ident != me and frame.f_code.co_name not in IDLE]
+            # under the lock, so samples are never added to once end() has returned
+            with self.lock:
+                if not self.active:
+                    self.thread = None
+                    return
+                for samples in self.active.values():
+                    samples.update(stacks)
+            time.sleep(self.interval)
+
+
+class ProfileStore:
+    """one collapsed stack file per route, merged into on every profiled request."""
+    def __init__(self, directory: str = PROFILE_DIR, max_stacks: int = PROFILE_MAX_STACKS,
+                 max_routes: int = PROFILE_MAX_ROUTES):
+        self.directory = directory
+        self.max_stacks = max_stacks
+        self.max_routes = max_routes
+        # several workers can merge into the same file, the last write wins and the other's samples are lost
+        self.lock = threading.Lock()
+
+    def path(self, key: str):
+        return os.path.join(self.directory, quote(key, safe='') + '.folded')
+
+    def read(self, key: str):
+        samples = Counter()
+        try:
+            with open(self.path(key)) as file:
+                for line in file:
+                    stack, _, count = line.rpartition(' ')
+                    try:
+                        samples[stack] += int(count)
+                    except ValueError:
+                        # a torn line, from a write that didn't finish
+                        continue
+        except FileNotFoundError:
+            pass
+        return samples
+
+    def add(self, key: str, samples: Counter):
+        if not samples:
+            return
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self.path(key)
+            if not os.path.exists(path) and len(self.files()) >= self.max_routes:
+                return
+            merged = self.read(key)
+            merged.update(samples)
+            # a temp file per process, so two workers writing the same route don't write into one file
+            tmp = f'{path}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as file:
+                # the rarest stacks go first once there are too many
+                file.writelines(f'{stack} {count}\n' for stack, count in merged.most_common(self.max_stacks))
+            os.replace(tmp, path)
+
+    def files(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.folded'))
+
+    def routes(self):
+        """sample counts by route."""
+        if not os.path.isdir(self.directory):
+            return {}
+        return {unquote(name[:-len('.folded')]): sum(self.read(unquote(name[:-len('.folded')])).values())
+                for name in self.files()}
+
+    def folded(self, key: str):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        with open(path) as file:
+            return file.read()
+
+
+store = ProfileStore()
+
+
+class ProfilerMiddleware:
+    """
+    only added when profiling is enabled (see main.py), so it costs nothing otherwise.
+    when it is, a request that isn't profiled costs a random() call and a header lookup.
+    """
+    def __init__(self, app, sample_rate: float = PROFILE_SAMPLE_RATE, token: str = PROFILE_TOKEN,
+                 sampler: Sampler = None, store: ProfileStore = store):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.token = token.encode()
+        self.sampler = sampler or Sampler()
+        self.store = store
+        self.route_template = RouteTemplates()
+
+    def wanted(self, scope):
+        if self.sample_rate and random.random() < self.sample_rate:
+            return True
+        if self.token:
+            for name, value in scope['headers']:
+                if name == PROFILE_HEADER:
+                    return hmac.compare_digest(value, self.token)
+        return False
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self.wanted(scope):
+            await self.app(scope, receive, send)
+            return
+        samples = self.sampler.begin()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.sampler.end(samples)
+            key = f"{scope['method']} {self.route_template(scope)}"
+            # the response has gone out, this only holds up the task
+            await run_in_threadpool(self.store.add, key, samples)
@@ -0,0 +1,273 @@
+import asyncio
+import glob
+import json
+import os
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from settings import METRICS_DIR, METRICS_FLUSH_SECONDS
+
+# counters, gauges and fixed bucket histograms kept per worker, rendered in the prometheus text format.
+# there are no locks: the http metrics are only touched from the event loop thread, and the few observed
+# from the threadpool (db checkouts) can at worst lose an increment when two threads race on one bucket.
+
+# seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, labels=(), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def snapshot(self):
+        # list() copies the items in one go, a thread adding a series meanwhile can't break the iteration
+        return [[list(labels), value] for labels, value in list(self.values.items())]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, labels=(), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def set(self, labels=(), value: float = 0):
+        self.values[labels] = value
+
+
+class Histogram(Counter):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, labels, value: float):
+        series = self.values.get(labels)
+        if series is None:
+            # one count per bucket plus +Inf, then the sum
+            series = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def snapshot(self):
+        return [[list(labels), list(series)] for labels, series in list(self.values.items())]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        # called before every snapshot, for gauges that are sampled rather than kept up to date
+        self.collectors = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        for collect in self.collectors:
+            collect()
+        return {
+            'pid': os.getpid(),
+            'metrics': {metric.name: metric.snapshot() for metric in self.metrics},
+        }
+
+
+registry = Registry()
+
+requests_total = registry.add(Counter(
+    'http_requests_total', 'Requests by route template, method and status.', ('route', 'method', 'status')))
+request_duration = registry.add(Histogram(
+    'http_request_duration_seconds', 'Request latency by route template and method.', ('route', 'method')))
+requests_in_flight = registry.add(Gauge(
+    'http_requests_in_flight', 'Requests being handled.'))
+threadpool_busy = registry.add(Gauge(
+    'threadpool_threads_busy', 'Threadpool threads running sync routes and dependencies.'))
+threadpool_size = registry.add(Gauge(
+    'threadpool_threads_total', 'Threadpool size.'))
+threadpool_waiting = registry.add(Gauge(
+    'threadpool_tasks_waiting', 'Sync routes and dependencies waiting for a thread.'))
+db_checkout_duration = registry.add(Histogram(
+    'db_pool_checkout_seconds', 'Time to get a database connection from the pool.', ('engine',)))
+db_checked_out = registry.add(Gauge(
+    'db_pool_connections_checked_out', 'Pooled connections in use.', ('engine',)))
+
+
+# the counters of every worker that has gone, added up. pid None, it's never alive
+RETIRED = 'retired.json'
+# the pid snapshots are being written for, a fork (or a reused pid) finds any file already there isn't its own
+_writing_for = None
+
+
+def snapshot_path(pid: int):
+    return os.path.join(METRICS_DIR, f'{pid}.json')
+
+
+def load_snapshot(path: str):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def dump_snapshot(path: str, snapshot: dict):
+    with open(path + '.tmp', 'w') as file:
+        json.dump(snapshot, file)
+    # readers never see a half written file
+    os.replace(path + '.tmp', path)
+
+
+@contextmanager
+def retiring():
+    """held by one worker at a time while it folds snapshots into RETIRED."""
+    try:
+        import fcntl
+    except ImportError:
+        # windows, no forked workers to share METRICS_DIR with
+        yield
+        return
+    with open(os.path.join(METRICS_DIR, 'retired.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def retire(paths):
+    """adds the counters of the snapshots at paths to RETIRED and deletes them, caller holds retiring()."""
+    if not paths:
+        return
+    retired_path = os.path.join(METRICS_DIR, RETIRED)
+    snapshots = [load_snapshot(retired_path) or {'pid': None, 'metrics': {}}]
+    snapshots += [snapshot for snapshot in map(load_snapshot, paths) if snapshot is not None]
+    merged = merge(snapshots)
+    dump_snapshot(retired_path, {'pid': None, 'metrics': {
+        name: [[list(labels), value] for labels, value in series.items()] for name, series in merged.items()}})
+    for path in paths:
+        os.remove(path)
+
+
+def write_snapshot():
+    global _writing_for
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = snapshot_path(os.getpid())
+    if _writing_for != os.getpid():
+        if os.path.exists(path):
+            # left by a worker that had this pid before, its totals mustn't be written over
+            with retiring():
+                retire([path])
+        _writing_for = os.getpid()
+    dump_snapshot(path, registry.snapshot())
+
+
+def read_snapshots():
+    """every worker's latest snapshot, this worker's taken just now, and the totals of those that have gone."""
+    if not METRICS_DIR:
+        return [registry.snapshot()]
+    write_snapshot()
+    snapshots = {}
+    for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+        snapshot = load_snapshot(path)
+        if snapshot is not None:
+            snapshots[path] = snapshot
+    # one file for all the workers that have gone, rather than one each for as long as the directory lives
+    dead = [path for path, snapshot in snapshots.items()
+            if snapshot['pid'] is not None and not alive(snapshot['pid'])]
+    if dead:
+        with retiring():
+            retire([path for path in dead if os.path.exists(path)])
+        retired = load_snapshot(os.path.join(METRICS_DIR, RETIRED))
+        snapshots = {path: snapshot for path, snapshot in snapshots.items()
+                     if path not in dead and snapshot['pid'] is not None}
+        if retired is not None:
+            snapshots[RETIRED] = retired
+    return list(snapshots.values())
+
+
+def alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def merge(snapshots):
+    """add up the workers' metrics. a dead worker's counters still count, its gauges don't."""
+    merged = {metric.name: {} for metric in registry.metrics}
+    kinds = {metric.name: metric.kind for metric in registry.metrics}
+    for snapshot in snapshots:
+        live = snapshot['pid'] is not None and alive(snapshot['pid'])
+        for name, series in snapshot['metrics'].items():
+            if name not in merged or (kinds[name] == 'gauge' and not live):
+                continue
+            for labels, value in series:
+                key = tuple(labels)
+                if kinds[name] == 'histogram':
+                    total = merged[name].get(key)
+                    merged[name][key] = value if total is None else [a + b for a, b in zip(total, value)]
+                else:
+                    merged[name][key] = merged[name].get(key, 0) + value
+    return merged
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def render(merged):
+    lines = []
+    for metric in registry.metrics:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for labels, value in sorted(merged[metric.name].items()):
+            if metric.kind != 'histogram':
+                lines.append(f'{metric.name}{format_labels(metric.labels, labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(list(metric.buckets) + ['+Inf'], value):
+                cumulative += count
+                le = format_labels(metric.labels, labels, [('le', bound)])
+                lines.append(f'{metric.name}_bucket{le} {cumulative}')
+            lines.append(f'{metric.name}_sum{format_labels(metric.labels, labels)} {value[-1]}')
+            lines.append(f'{metric.name}_count{format_labels(metric.labels, labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+async def flush_periodically():
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_SECONDS)
+        write_snapshot()
+
+
+_flusher = None
+
+
+def start_flushing():
+    global _flusher
+    if METRICS_DIR and _flusher is None:
+        _flusher = asyncio.create_task(flush_periodically())
+
+
+async def stop_flushing():
+    global _flusher
+    if _flusher is not None:
+        _flusher.cancel()
+        _flusher = None
+        # the last requests this worker served still count once it's gone
+        write_snapshot()
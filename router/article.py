@@ -1,25 +1,36 @@
-from fastapi import APIRouter, Depends
-from schemas import ArticleBase, ArticleDisplay, ArticleUserDisplay
+from fastapi import APIRouter, Depends, Query
+from admission.limiter import admission
+from schemas import ArticleBase, ArticleDisplay, ArticlePage, ArticleUserDisplay
 from sqlalchemy.orm.session import Session
 from db import db_article
-from db.database import get_db
+from db.pagination import DEFAULT_LIMIT, MAX_LIMIT
+from db.database import get_db, get_read_db
 from schemas import UserBase
 from auth.outh2 import get_current_user
-from typing import Dict, List
+from typing import Dict, List, Optional
+from serialization import model_response
 
 router = APIRouter(
     prefix="/articles",
-    tags=["articles"]
+    tags=["articles"],
+    dependencies=[Depends(admission('db'))]
 )
 
+@router.get("/", response_model=ArticlePage)
+def get_all_articles(limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+                     after: Optional[str] = None,
+                     db: Session = Depends(get_read_db),
+                     current_user: UserBase = Depends(get_current_user)):
+    return model_response(db_article.get_all_articles(db, limit, after), ArticlePage)
+
 @router.get("/{id}", response_model=ArticleUserDisplay)
 def get_article(id: int,
-                db: Session = Depends(get_db),
+                db: Session = Depends(get_read_db),
                 current_user: UserBase = Depends(get_current_user)):
-    return {
+    return model_response({
         'data': db_article.get_article(db, id),
         'current_user': current_user
-    }
+    }, ArticleUserDisplay)
 
 @router.post("/", response_model=ArticleDisplay)
 def create_article(request: ArticleBase,
@@ -0,0 +1,40 @@
+from fastapi import APIRouter, Depends, Query
+from admission.limiter import admission
+from schemas import ArticleBase, ArticleDisplay, ArticlePage, ArticleUserDisplay
+from sqlalchemy.ext.asyncio import AsyncSession
+from db import db_article_async
+from db.pagination import DEFAULT_LIMIT, MAX_LIMIT
+from db.database import get_async_db
+from schemas import UserBase
+from auth.outh2 import get_current_user_async
+from typing import Optional
+from serialization import model_response
+
+# async version of article.py, used when DB_ASYNC is set.
+router = APIRouter(
+    prefix="/articles",
+    tags=["articles"],
+    dependencies=[Depends(admission('db'))]
+)
+
+@router.get("/", response_model=ArticlePage)
+async def get_all_articles(limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+                           after: Optional[str] = None,
+                           db: AsyncSession = Depends(get_async_db),
+                           current_user: UserBase = Depends(get_current_user_async)):
+    return model_response(await db_article_async.get_all_articles(db, limit, after), ArticlePage)
+
+@router.get("/{id}", response_model=ArticleUserDisplay)
+async def get_article(id: int,
+                      db: AsyncSession = Depends(get_async_db),
+                      current_user: UserBase = Depends(get_current_user_async)):
+    return model_response({
+        'data': await db_article_async.get_article(db, id),
+        'current_user': current_user
+    }, ArticleUserDisplay)
+
+@router.post("/", response_model=ArticleDisplay)
+async def create_article(request: ArticleBase,
+                         db: AsyncSession = Depends(get_async_db),
+                         current_user: UserBase = Depends(get_current_user_async)):
+    return await db_article_async.create_article(db, request)
@@ -0,0 +1,241 @@
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from admission.limiter import admission
+from auth.outh2 import get_current_user
+from db import db_article, db_user
+from db.database import get_db
+from db.hash import Hash
+from schemas import ArticleBase, BulkReport, UserBase
+from serialization import model_response
+from settings import BULK_BATCH_SIZE, BULK_MAX_BODY_BYTES, BULK_MAX_ROWS
+
+# bulk versions of the create routes. the body is either a json list of rows, or (with
+# Content-Type: application/x-ndjson) one row per line, read as it arrives so a big upload is never held in
+# memory whole. every row gets a result, its new id or why it was turned down, and a bad row doesn't stop
+# the others. /articles/import is for migrations too big for one response, see import_articles.
+router = APIRouter(
+    tags=["bulk"]
+)
+
+NDJSON = 'application/x-ndjson'
+# a longer ndjson line than this is a client error rather than a row
+MAX_LINE_BYTES = 1024 * 1024
+
+
+class InvalidRow(Exception):
+    pass
+
+
+def too_many_rows():
+    return HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                         detail=f"Only {BULK_MAX_ROWS} rows are taken in one request")
+
+
+def body_too_large():
+    return HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                         detail=f"A json body can be at most {BULK_MAX_BODY_BYTES} bytes, send ndjson instead")
+
+
+async def limited_body(request: Request):
+    """request.body(), but turned down as soon as it's past BULK_MAX_BODY_BYTES rather than once it's all in memory."""
+    length = request.headers.get('content-length', '')
+    if length.isdigit() and int(length) > BULK_MAX_BODY_BYTES:
+        raise body_too_large()
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > BULK_MAX_BODY_BYTES:
+            raise body_too_large()
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+async def ndjson_lines(request: Request):
+    buffer = b''
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        if len(buffer) > MAX_LINE_BYTES:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                detail=f"Lines can be at most {MAX_LINE_BYTES} bytes")
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+
+async def read_rows(request: Request):
+    """the decoded rows of the body, or an InvalidRow for a line that isn't json."""
+    if request.headers.get('content-type', '').startswith(NDJSON):
+        async for line in ndjson_lines(request):
+            if not line.strip():
+                continue
+            try:
+                yield orjson.loads(line)
+            except orjson.JSONDecodeError as error:
+                yield InvalidRow(f"Invalid json: {error}")
+        return
+    try:
+        rows = orjson.loads(await limited_body(request))
+    except orjson.JSONDecodeError as error:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid json: {error}")
+    if not isinstance(rows, list):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Expected a list of rows")
+    if len(rows) > BULK_MAX_ROWS:
+        raise too_many_rows()
+    for row in rows:
+        yield row
+
+
+def parse(schema, row):
+    if isinstance(row, InvalidRow):
+        raise row
+    try:
+        return schema.parse_obj(row)
+    except ValidationError as error:
+        raise InvalidRow('; '.join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in error.errors()))
+
+
+async def bulk_create(request: Request, schema, create_batch):
+    """parses the rows of the request into schema, and hands them to create_batch BULK_BATCH_SIZE at a time."""
+    results = []
+    batch = []
+
+    async for row in read_rows(request):
+        index = len(results)
+        if index >= BULK_MAX_ROWS:
+            # an ndjson upload only shows how long it is as it goes, the batches before this are committed
+            raise too_many_rows()
+        results.append({'index': index})
+        try:
+            batch.append((index, parse(schema, row)))
+        except InvalidRow as error:
+            results[index]['error'] = str(error)
+        if len(batch) >= BULK_BATCH_SIZE:
+            await create_batch(batch, results)
+            batch = []
+    if batch:
+        await create_batch(batch, results)
+
+    failed = sum(1 for result in results if 'error' in result)
+    return model_response({'created': len(results) - failed, 'failed': failed, 'results': results}, BulkReport)
+
+
+# admitted with the logins, it's what competes with them for the hashing pool
+@router.post('/user/bulk', response_model=BulkReport, dependencies=[Depends(admission('auth'))])
+async def create_users(request: Request,
+                       db: Session = Depends(get_db),
+                       current_user: UserBase = Depends(get_current_user)):
+    async def create_batch(batch, results):
+        usernames = [user.username for _, user in batch]
+        taken = await run_in_threadpool(db_user.taken_usernames, db, usernames)
+        new = []
+        for index, user in batch:
+            if user.username in taken:
+                results[index]['error'] = f"Username {user.username} is taken"
+            else:
+                # a username twice in the same request, the first one gets it
+                taken.add(user.username)
+                new.append((index, user))
+        if not new:
+            return
+        hashes = await Hash.bcrypt_many_async([user.password for _, user in new])
+        rows = [{'username': user.username, 'email': user.email, 'password': hashed}
+                for (_, user), hashed in zip(new, hashes)]
+        try:
+            ids = await run_in_threadpool(db_user.create_users, db, rows)
+        except SQLAlchemyError as error:
+            await run_in_threadpool(db.rollback)
+            for index, _ in new:
+                results[index]['error'] = f"Not created: {error.__class__.__name__}"
+            return
+        for (index, user), id in zip(new, ids):
+            if id is None:
+                # taken by another request while this one was hashing
+                results[index]['error'] = f"Username {user.username} is taken"
+            else:
+                results[index]['id'] = id
+
+    return await bulk_create(request, UserBase, create_batch)
+
+
+class ImportResponse(StreamingResponse):
+    """
+    StreamingResponse also listens for the client disconnecting, which reads the request body from under
+    an import still reading it. without that, a client that goes away is noticed when the body ends early.
+    """
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+
+def result_line(**fields):
+    return orjson.dumps(fields, option=orjson.OPT_APPEND_NEWLINE)
+
+
+async def import_lines(request: Request, db: Session, batch_size: int):
+    counts = {'created': 0, 'failed': 0}
+    batch = []
+
+    async def insert():
+        """the lines of the batch that failed, the rest are committed."""
+        creators = await run_in_threadpool(db_user.existing_ids, db, {article.creator_id for _, article in batch})
+        errors = [(number, f"User with id: {article.creator_id} not found")
+                  for number, article in batch if article.creator_id not in creators]
+        valid = [(number, article) for number, article in batch if article.creator_id in creators]
+        if valid:
+            rows = [{'title': article.title, 'content': article.content, 'published': article.published,
+                     'user_id': article.creator_id} for _, article in valid]
+            try:
+                await run_in_threadpool(db_article.create_articles, db, rows)
+                counts['created'] += len(rows)
+            except SQLAlchemyError as error:
+                await run_in_threadpool(db.rollback)
+                errors += [(number, f"Not created: {error.__class__.__name__}") for number, _ in valid]
+        counts['failed'] += len(errors)
+        return errors
+
+    number = 0
+    async for text in ndjson_lines(request):
+        number += 1
+        if not text.strip():
+            continue
+        try:
+            article = parse(ArticleBase, orjson.loads(text))
+            emails = db_article.find_emails(article.content)
+            if emails:
+                raise InvalidRow(f"Content contains email(s): {', '.join(emails)}")
+        except (orjson.JSONDecodeError, InvalidRow) as error:
+            counts['failed'] += 1
+            yield result_line(line=number, error=str(error))
+            continue
+        batch.append((number, article))
+        if len(batch) >= batch_size:
+            for failed, error in await insert():
+                yield result_line(line=failed, error=error)
+            batch = []
+            yield result_line(line=number, **counts)
+    if batch:
+        for failed, error in await insert():
+            yield result_line(line=failed, error=error)
+    yield result_line(line=number, **counts, done=True)
+
+
+@router.post('/articles/import', response_class=ImportResponse, dependencies=[Depends(admission('db'))])
+async def import_articles(request: Request,
+                          batch_size: int = Query(BULK_BATCH_SIZE, ge=1, le=10000),
+                          db: Session = Depends(get_db),
+                          current_user: UserBase = Depends(get_current_user)):
+    """
+    imports an ndjson upload of articles, one ArticleBase per line, committing batch_size at a time. the
+    response is ndjson as well, streamed while the upload is read: {"line", "error"} for every line that
+    wasn't imported, {"line", "created", "failed"} after every batch, and the same with "done" at the end.
+    what was committed before a failure or a dropped connection stays.
+    """
+    return ImportResponse(import_lines(request, db, batch_size), media_type=NDJSON)
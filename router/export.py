@@ -0,0 +1,39 @@
+from fastapi import APIRouter, Depends, Query
+from admission.limiter import admission
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+from db import db_user, db_article
+from db.database import get_read_db
+from schemas import UserBase, UserDisplay, ArticleDisplay
+from auth.outh2 import get_current_user
+from serialization import ndjson_line
+
+# full dumps as newline delimited json, streamed row by row so memory doesn't grow with the table.
+# included before the user and article routers so /user/export isn't matched as /user/{id}.
+router = APIRouter(
+    tags=["export"],
+    dependencies=[Depends(admission('db'))]
+)
+
+EXPORT_BATCH_SIZE = 1000
+
+
+def ndjson(rows, schema):
+    for row in rows:
+        yield ndjson_line(row, schema)
+
+
+@router.get('/user/export', response_class=StreamingResponse)
+def export_users(batch_size: int = Query(EXPORT_BATCH_SIZE, ge=1, le=10000),
+                 db: Session = Depends(get_read_db),
+                 current_user: UserBase = Depends(get_current_user)):
+    return StreamingResponse(ndjson(db_user.iter_users(db, batch_size), UserDisplay),
+                             media_type='application/x-ndjson')
+
+
+@router.get('/articles/export', response_class=StreamingResponse)
+def export_articles(batch_size: int = Query(EXPORT_BATCH_SIZE, ge=1, le=10000),
+                    db: Session = Depends(get_read_db),
+                    current_user: UserBase = Depends(get_current_user)):
+    return StreamingResponse(ndjson(db_article.iter_articles(db, batch_size), ArticleDisplay),
+                             media_type='application/x-ndjson')
@@ -0,0 +1,47 @@
+import hmac
+from fastapi import APIRouter, Depends, Header, HTTPException, status
+from fastapi.responses import PlainTextResponse
+from db.cache import cache_stats
+from chat.hub import hub
+from logs.logging import sink
+from metrics.profiler import store
+from settings import PROFILE_TOKEN
+
+router = APIRouter(
+    prefix='/monitoring',
+    tags=['monitoring']
+)
+
+# hit/miss/eviction counters for every read-through cache
+@router.get('/cache')
+def get_cache_stats():
+    return cache_stats()
+
+# websocket rooms, connections and slow consumer counters
+@router.get('/chat')
+def get_chat_stats():
+    return hub.stats()
+
+# log records waiting, written and dropped by the log writer
+@router.get('/logs')
+def get_log_stats():
+    return sink.stats()
+
+
+def require_profile_token(x_profile: str = Header(default='')):
+    # hidden entirely unless PROFILE_TOKEN is set, and then only for callers that send it
+    if not PROFILE_TOKEN or not hmac.compare_digest(x_profile.encode(), PROFILE_TOKEN.encode()):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Not Found')
+
+# sample counts of every profiled route
+@router.get('/profiles', dependencies=[Depends(require_profile_token)])
+def get_profiles():
+    return store.routes()
+
+# collapsed stacks of one route, e.g. ?route=GET /user/ , ready for flamegraph.pl or speedscope
+@router.get('/profiles/folded', response_class=PlainTextResponse, dependencies=[Depends(require_profile_token)])
+def get_profile(route: str):
+    folded = store.folded(route)
+    if folded is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'No profile for {route}')
+    return folded
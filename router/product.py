@@ -1,10 +1,15 @@
 import time
 
-from fastapi import APIRouter, Header, Cookie, Form
-from fastapi.responses import Response, HTMLResponse, PlainTextResponse
+from fastapi import APIRouter, Header, Cookie, Depends, Form, HTTPException, Query, Request, status
+from fastapi.responses import Response, HTMLResponse, PlainTextResponse, JSONResponse
+from sqlalchemy.orm import Session
 from typing import Optional, List, Union
 
+from db import db_product
+from db.database import SessionLocal, get_db, get_read_db
+from jobs.queue import jobs, task
 from logs.logging import log
+from schemas import JobDisplay
 
 router = APIRouter(
     prefix="/product",
@@ -12,20 +17,33 @@ router = APIRouter(
 )
 
 
-# dummy data
-products = ['watch', 'camera', 'phone']
+# runs on a job worker thread, see jobs/queue.py. sleeping here used to stall the whole event loop.
+@task('product.all')
+def time_consuming_functionality():
+    time.sleep(5)
+    with SessionLocal() as db:
+        return ' '.join(db_product.get_product_names(db))
 
 
-async def time_consuming_functionality():
-    time.sleep(5)
+@router.get('/all', responses={202: {'model': JobDisplay, 'description': 'the job, when wait=false'}})
+async def get_all_products(request: Request, wait: bool = True):
+    id = jobs.submit('product.all')
+    log('myapi', 'call to get all products', request)
+    if not wait:
+        job = jobs.get(id)
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=job.dict(),
+                            headers={'Location': router.url_path_for('get_job', id=id)})
+    job = await jobs.wait(id)
+    return Response(content=job.result, media_type='text/plain')
 
 
-@router.get('/all')
-async def get_all_products():
-    await time_consuming_functionality()
-    log('myapi', 'call to get all products')
-    data = ' '.join(products)
-    return Response(content=data, media_type='text/plain')
+@router.get('/jobs/{id}', response_model=JobDisplay)
+async def get_job(id: str, wait: float = Query(0, ge=0, le=30)):
+    """the job's status and result, waiting up to wait seconds for it to finish."""
+    job = await jobs.wait(id, wait) if wait else jobs.get(id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'Job with id {id} not found')
+    return job
 
 
 @router.get('/{id}', responses={
@@ -47,40 +65,35 @@ async def get_all_products():
         'description': 'a clear text error message'
         }
 })
-def get_product(id: int):
-    if id > len(products):
+def get_product(id: int, db: Session = Depends(get_read_db)):
+    out = db_product.get_product_html(db, id)
+    if out is None:
         out = "product not available"
         return PlainTextResponse(status_code=404, content=out, media_type='text/plain')
-    else:
-        product = products[id]
-        out = f'''
-        <head>
-           '{product}'
-        </head>
-        '''
-        return HTMLResponse(content=out, media_type='text/html')
+    return HTMLResponse(content=out, media_type='text/html')
 
 @router.get('/withheader/')
-def get_products(custom_header: Optional[List[str]] = Header(default=None)):
-    return products
+def get_products(custom_header: Optional[List[str]] = Header(default=None), db: Session = Depends(get_read_db)):
+    return db_product.get_product_names(db)
 
 
 @router.get('/withheader121/')
 def get_products(response: Response,
-                 custom_header: Optional[List[str]] = Header(default=None)):
+                 custom_header: Optional[List[str]] = Header(default=None),
+                 db: Session = Depends(get_read_db)):
     response.headers['response_custom_header'] = ', '.join(custom_header)
-    return products
+    return db_product.get_product_names(db)
 
 @router.get('/createcookie/')
-def create_cookie(response: Response):
+def create_cookie(response: Response, db: Session = Depends(get_read_db)):
     response.set_cookie(key='custom_cookie', value='cookie_value')
-    return products
+    return db_product.get_product_names(db)
 
 @router.get('/getcookie/')
 def get_cookie(custom_cookie: Union[str, None] = Cookie(None)):
     return {'my_cookie': custom_cookie}
 
 @router.post('/new')
-def create_product(name: str = Form(...)):
-    products.append(name)
-    return products
+def create_product(name: str = Form(...), db: Session = Depends(get_db)):
+    db_product.create_product(db, name)
+    return db_product.get_product_names(db)
@@ -0,0 +1,12 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from metrics.registry import merge, read_snapshots, render
+
+router = APIRouter(
+    tags=['monitoring']
+)
+
+# request counts, latencies, threadpool and db pool usage of every worker, in the prometheus text format
+@router.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(render(merge(read_snapshots())), media_type='text/plain; version=0.0.4')
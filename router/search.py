@@ -0,0 +1,23 @@
+from fastapi import APIRouter, Depends, Query
+from admission.limiter import admission
+from sqlalchemy.orm.session import Session
+from db import search
+from db.database import get_read_db
+from db.pagination import DEFAULT_LIMIT, MAX_LIMIT
+from schemas import ArticleSearchPage, UserBase
+from auth.outh2 import get_current_user
+
+# included before the article router so /articles/search isn't matched as /articles/{id}.
+router = APIRouter(
+    prefix="/articles",
+    tags=["articles"],
+    dependencies=[Depends(admission('db'))]
+)
+
+@router.get("/search", response_model=ArticleSearchPage)
+def search_articles(q: str = Query(..., min_length=1),
+                    limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+                    offset: int = Query(0, ge=0),
+                    db: Session = Depends(get_read_db),
+                    current_user: UserBase = Depends(get_current_user)):
+    return search.search_articles(db, q, limit, offset)
@@ -1,37 +1,49 @@
-from fastapi import APIRouter, Depends
-from schemas import UserBase, UserDisplay
+from fastapi import APIRouter, Depends, Query
+from starlette.concurrency import run_in_threadpool
+from admission.limiter import admission
+from schemas import UserBase, UserDisplay, UserPage
 from sqlalchemy.orm import Session
-from db.database import get_db
+from db.database import get_db, get_read_db
 from db import db_user
-from typing import List
+from db.hash import Hash
+from db.pagination import DEFAULT_LIMIT, MAX_LIMIT
+from typing import Optional
 from auth.outh2 import get_current_user
+from serialization import model_response
 
 router = APIRouter(
     prefix="/user",
-    tags=["user"]
+    tags=["user"],
+    dependencies=[Depends(admission('db'))]
 )
 
 # create user
+# async so the bcrypt hash (in the hashing process pool) doesn't hold a threadpool worker, the queries still run in one.
 @router.post('/', response_model=UserDisplay)
-def create_user(request: UserBase, db: Session = Depends(get_db)):
-    return db_user.create_user(db, request)
+async def create_user(request: UserBase, db: Session = Depends(get_db)):
+    hashed_password = await Hash.bcrypt_async(request.password)
+    return await run_in_threadpool(db_user.create_user, db, request, hashed_password)
 
-# read all users
-@router.get("/", response_model=List[UserDisplay])
-def get_all_users(db: Session = Depends(get_db), current_user: UserBase = Depends(get_current_user)):
-    return db_user.get_all_users(db)
+# read all users, a page at a time
+@router.get("/", response_model=UserPage)
+def get_all_users(limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+                  after: Optional[str] = None,
+                  db: Session = Depends(get_read_db),
+                  current_user: UserBase = Depends(get_current_user)):
+    return model_response(db_user.get_all_users(db, limit, after), UserPage)
 
 # read one user
 @router.get("/{id}", response_model=UserDisplay)
-def get_one_user(id: int, db: Session = Depends(get_db), current_user: UserBase = Depends(get_current_user)):
-    return db_user.get_one_user(id, db)
+def get_one_user(id: int, db: Session = Depends(get_read_db), current_user: UserBase = Depends(get_current_user)):
+    return model_response(db_user.get_one_user(id, db), UserDisplay)
 
-# update user
+# update user, async for the same reason as create_user
 @router.put("/{id}/update", response_model=UserDisplay)
-def update_username(request: UserBase, id: int,
-                    db: Session = Depends(get_db),
-                    current_user: UserBase = Depends(get_current_user)):
-    return db_user.update_user(request, db, id)
+async def update_username(request: UserBase, id: int,
+                          db: Session = Depends(get_db),
+                          current_user: UserBase = Depends(get_current_user)):
+    hashed_password = await Hash.bcrypt_async(request.password)
+    return await run_in_threadpool(db_user.update_user, request, db, id, hashed_password)
 
 # delete user
 @router.delete("/{id}/delete")
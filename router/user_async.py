@@ -0,0 +1,51 @@
+from fastapi import APIRouter, Depends, Query
+from admission.limiter import admission
+from schemas import UserBase, UserDisplay, UserPage
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.database import get_async_db
+from db import db_user_async
+from db.pagination import DEFAULT_LIMIT, MAX_LIMIT
+from typing import Optional
+from auth.outh2 import get_current_user_async
+from serialization import model_response
+
+# async version of user.py, used when DB_ASYNC is set.
+router = APIRouter(
+    prefix="/user",
+    tags=["user"],
+    dependencies=[Depends(admission('db'))]
+)
+
+# create user
+@router.post('/', response_model=UserDisplay)
+async def create_user(request: UserBase, db: AsyncSession = Depends(get_async_db)):
+    return await db_user_async.create_user(db, request)
+
+# read all users, a page at a time
+@router.get("/", response_model=UserPage)
+async def get_all_users(limit: int = Query(DEFAULT_LIMIT, ge=1, le=MAX_LIMIT),
+                        after: Optional[str] = None,
+                        db: AsyncSession = Depends(get_async_db),
+                        current_user: UserBase = Depends(get_current_user_async)):
+    return model_response(await db_user_async.get_all_users(db, limit, after), UserPage)
+
+# read one user
+@router.get("/{id}", response_model=UserDisplay)
+async def get_one_user(id: int,
+                       db: AsyncSession = Depends(get_async_db),
+                       current_user: UserBase = Depends(get_current_user_async)):
+    return model_response(await db_user_async.get_one_user(id, db), UserDisplay)
+
+# update user
+@router.put("/{id}/update", response_model=UserDisplay)
+async def update_username(request: UserBase, id: int,
+                          db: AsyncSession = Depends(get_async_db),
+                          current_user: UserBase = Depends(get_current_user_async)):
+    return await db_user_async.update_user(request, db, id)
+
+# delete user
+@router.delete("/{id}/delete")
+async def delete_user(id: int,
+                      db: AsyncSession = Depends(get_async_db),
+                      current_user: UserBase = Depends(get_current_user_async)):
+    return await db_user_async.delete_user(db, id)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List
+from typing import Any, List, Optional
 
 # Article inside UserDisplay
 class Article(BaseModel):
@@ -22,6 +22,11 @@ class UserDisplay(BaseModel):
     class Config:
         orm_mode = True
 
+# a page of users, next_cursor is passed back as ?after= to get the next page
+class UserPage(BaseModel):
+    items: List[UserDisplay]
+    next_cursor: Optional[str] = None
+
 # user inside ArticleDisplay
 class User(BaseModel):
     id: int
@@ -45,6 +50,22 @@ class ArticleDisplay(BaseModel):
         orm_mode = True
 
 
+class ArticlePage(BaseModel):
+    items: List[ArticleDisplay]
+    next_cursor: Optional[str] = None
+
+
+class ArticleSearchHit(BaseModel):
+    article: ArticleDisplay
+    snippet: str
+
+
+# search results are ranked, so they page by offset rather than by cursor
+class ArticleSearchPage(BaseModel):
+    items: List[ArticleSearchHit]
+    next_offset: Optional[int] = None
+
+
 class ArticleUser(BaseModel):
     id: int
     published: bool
@@ -60,7 +81,31 @@ class ArticleUserDisplay(BaseModel):
     current_user: User
 
 
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+
+class JobDisplay(BaseModel):
+    id: str
+    name: str
+    status: str
+    result: Any = None
+    error: Optional[str] = None
+
+
 class ProductBase(BaseModel):
     title: str
     description: str
-    price: float
\ No newline at end of file
+    price: float
+
+# one row of a bulk request, by its position in the request (from 0, blank ndjson lines aren't counted)
+class BulkRowResult(BaseModel):
+    index: int
+    id: Optional[int] = None
+    error: Optional[str] = None
+
+
+class BulkReport(BaseModel):
+    created: int
+    failed: int
+    results: List[BulkRowResult]
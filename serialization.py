@@ -0,0 +1,73 @@
+import orjson
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_LIST, SHAPE_SINGLETON
+
+from settings import JSON_RESPONSE
+
+# a route returning orm rows has them validated into its response_model, turned back into dicts by
+# jsonable_encoder and only then dumped, which is most of the time a list endpoint takes. for the hot routes
+# encoder() builds, once per model, a function that reads the model's fields straight off the rows (or dicts,
+# or model instances) and the result goes to orjson as is. the rows come from our own tables, so nothing is
+# validated on the way out: a value of the wrong type is dumped as it is rather than coerced.
+
+FAST = JSON_RESPONSE == 'orjson'
+
+_encoders = {}
+
+
+def response_class():
+    """the app's default_response_class."""
+    return ORJSONResponse if FAST else JSONResponse
+
+
+def _identity(value):
+    return value
+
+
+def _field_encoder(field):
+    if not (isinstance(field.type_, type) and issubclass(field.type_, BaseModel)):
+        if field.shape == SHAPE_LIST:
+            return list
+        return _identity
+    encode = encoder(field.type_)
+    if field.shape == SHAPE_SINGLETON:
+        return lambda value: None if value is None else encode(value)
+    if field.shape == SHAPE_LIST:
+        return lambda values: [encode(value) for value in values]
+    raise TypeError(f'{field.name}: only single models and lists of models can be encoded')
+
+
+def encoder(model):
+    """a function giving what model.from_orm(row).dict() would, without building the model."""
+    encode = _encoders.get(model)
+    if encode is None:
+        fields = [(field.alias, field.default, _field_encoder(field)) for field in model.__fields__.values()]
+
+        def encode(value):
+            if isinstance(value, dict):
+                return {name: convert(value.get(name, default)) for name, default, convert in fields}
+            return {name: convert(getattr(value, name, default)) for name, default, convert in fields}
+        _encoders[model] = encode
+    return encode
+
+
+def dumps(content, model):
+    return orjson.dumps(encoder(model)(content))
+
+
+def model_response(content, model):
+    """
+    what a route returns for content as model. the route still declares model as its response_model for the
+    docs, fastapi sends a returned Response as it is. with JSON_RESPONSE=json the content is returned as it
+    is, and validated and encoded the usual way.
+    """
+    if not FAST:
+        return content
+    return Response(dumps(content, model), media_type='application/json')
+
+
+def ndjson_line(row, model):
+    if FAST:
+        return orjson.dumps(encoder(model)(row), option=orjson.OPT_APPEND_NEWLINE)
+    return (model.from_orm(row).json() + '\n').encode()
@@ -0,0 +1,136 @@
+"""
+Production entrypoint: a parent process that sets up the database once, binds the socket, and forks the workers.
+
+    python serve.py --workers 4 --max-requests 10000
+
+Each worker is a uvicorn server on the shared socket, using uvloop and httptools when they're installed.
+SIGTERM (or ctrl-c) stops the workers taking new connections and lets them finish what they're serving,
+and a worker that has served --max-requests is replaced by a fresh one. Unix only, workers are forked.
+"""
+
+import argparse
+import os
+import random
+import signal
+import socket
+import sys
+import time
+import traceback
+
+import uvicorn
+
+from db import hash as hashing
+from db.database import async_engine, engine, read_engine
+from db.schema import init_db
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--loop', default='auto', choices=['auto', 'asyncio', 'uvloop'],
+                        help='auto picks uvloop when it is installed')
+    parser.add_argument('--http', default='auto', choices=['auto', 'h11', 'httptools'],
+                        help='auto picks httptools when it is installed')
+    parser.add_argument('--max-requests', type=int, default=0,
+                        help='replace a worker after it has served this many requests, 0 never does')
+    parser.add_argument('--max-requests-jitter', type=int, default=0,
+                        help='up to this many more, so the workers are not all replaced at once')
+    parser.add_argument('--graceful-timeout', type=float, default=30,
+                        help='seconds the workers get to finish their requests on shutdown before being killed')
+    parser.add_argument('--backlog', type=int, default=2048)
+    return parser.parse_args()
+
+
+def bind(host: str, port: int, backlog: int):
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def dispose_engines():
+    # connections must not be shared between processes. close=False leaves the other process's alone.
+    for bind in {engine, read_engine, async_engine.sync_engine}:
+        bind.dispose(close=False)
+
+
+def run_worker(args, sock):
+    # the parent's handlers forward signals, a worker leaves them to uvicorn
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    dispose_engines()
+    max_requests = None
+    if args.max_requests:
+        max_requests = args.max_requests + random.randint(0, args.max_requests_jitter)
+    # the app was imported by the parent, so each fork starts with it already loaded
+    from main import app
+    config = uvicorn.Config(app, loop=args.loop, http=args.http, limit_max_requests=max_requests, backlog=args.backlog)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def spawn(args, sock):
+    pid = os.fork()
+    if pid == 0:
+        # never return into the parent's loop
+        try:
+            run_worker(args, sock)
+        except BaseException:
+            traceback.print_exc()
+            os._exit(1)
+        os._exit(0)
+    return pid
+
+
+def main():
+    args = parse_args()
+    # once here, rather than in every worker at startup
+    init_db()
+    dispose_engines()
+    # the workers inherit the bcrypt cost and the size of their hashing pools
+    hashing.prepare_for_workers(args.workers)
+    import main as _  # noqa: F401, loaded before forking so the workers share its memory
+
+    sock = bind(args.host, args.port, args.backlog)
+    workers = {spawn(args, sock) for _ in range(args.workers)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f'serving on http://{args.host}:{args.port} with {args.workers} workers', file=sys.stderr)
+
+    deadline = None
+    while workers:
+        if stopping and deadline is None:
+            deadline = time.monotonic() + args.graceful_timeout
+        if deadline is not None and time.monotonic() > deadline:
+            for pid in workers:
+                os.kill(pid, signal.SIGKILL)
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            time.sleep(0.1)
+            continue
+        workers.discard(pid)
+        if not stopping:
+            # served its max requests (or crashed), replace it
+            workers.add(spawn(args, sock))
+    sock.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,118 @@
 import os
 
+from dotenv import load_dotenv
+
 PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+load_dotenv()
+
+# sqlite file used by both the sync and the async engine
+DATABASE_PATH = os.getenv("DATABASE_PATH", os.path.join(PROJECT_DIR, 'fastapi-practice.db'))
+
+# DB_ASYNC=true serves the user, article and auth routes from the aiosqlite engine
+# instead of running sync handlers in the threadpool.
+DB_ASYNC = os.getenv("DB_ASYNC", "false").lower() == "true"
+
+# DB_PROFILE=production opens sqlite in WAL mode with the pragmas below, pools connections and
+# sends GET handlers to a separate read-only pool. "default" leaves sqlite's defaults alone.
+DB_PROFILE = os.getenv("DB_PROFILE", "default")
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", 256 * 1024 * 1024))
+# negative values are KiB rather than pages
+DB_CACHE_SIZE = int(os.getenv("DB_CACHE_SIZE", -64000))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", 10))
+
+# read-through cache in front of user and article lookups, CACHE_BACKEND=none turns it off
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "lru")
+CACHE_MAXSIZE = int(os.getenv("CACHE_MAXSIZE", 1024))
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", 30))
+
+# bcrypt runs in a pool of HASH_WORKERS processes (0 hashes inline). under serve.py it defaults to the cores
+# shared out between the workers, and the cost is calibrated once in the parent.
+# the cost is calibrated at startup to take about BCRYPT_TARGET_MS, unless BCRYPT_ROUNDS pins it.
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", min(4, os.cpu_count() or 1)))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 0))
+BCRYPT_TARGET_MS = float(os.getenv("BCRYPT_TARGET_MS", 250))
+# resolved principals (token subject -> user) are only cached briefly, an update or delete also drops them
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", 10))
+
+# refresh tokens are rotated on every use and stored (hashed) so they can be revoked
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", 30))
+
+# every websocket gets a send queue of WS_QUEUE_SIZE messages. when a client can't keep up,
+# WS_SLOW_CONSUMER_POLICY either drops its oldest queued message ("drop_oldest") or disconnects it ("disconnect").
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", 100))
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "drop_oldest")
+# messages kept per room for clients that reconnect with ?last_seen=<seq>
+WS_HISTORY_SIZE = int(os.getenv("WS_HISTORY_SIZE", 256))
+# for at most WS_HISTORY_ROOMS rooms, the ones that have gone longest without a message are forgotten first
+WS_HISTORY_ROOMS = int(os.getenv("WS_HISTORY_ROOMS", 1000))
+
+# CHAT_BACKEND=unix relays /endpoint messages between the workers on this host through a broker on
+# CHAT_SOCKET_PATH, batching them every CHAT_TICK_MS. "memory" only reaches clients of the same process.
+CHAT_BACKEND = os.getenv("CHAT_BACKEND", "memory")
+# by default in a directory of the app's that only its user can get into, rather than in the shared /tmp
+CHAT_SOCKET_PATH = os.getenv("CHAT_SOCKET_PATH", os.path.join(PROJECT_DIR, 'run', 'chat.sock'))
+CHAT_TICK_MS = float(os.getenv("CHAT_TICK_MS", 5))
+
+# slow work (see router/product.py) runs on JOB_WORKERS threads instead of the event loop.
+# JOB_BACKEND=database keeps jobs in the jobs table, so queued ones are picked up again after a restart.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+JOB_BACKEND = os.getenv("JOB_BACKEND", "memory")
+# with the database backend a worker claims a job for JOB_LEASE_SECONDS, and renews the claim while it runs
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", 60))
+# the memory backend keeps the results of the last JOB_KEEP_FINISHED finished jobs, older ones are dropped
+JOB_KEEP_FINISHED = int(os.getenv("JOB_KEEP_FINISHED", 1000))
+
+# rendered products are cached per worker, and dropped once the catalog version in the database changes.
+# each worker checks the version at most every CATALOG_VERSION_CHECK_SECONDS.
+CATALOG_VERSION_CHECK_SECONDS = float(os.getenv("CATALOG_VERSION_CHECK_SECONDS", 1))
+
+# log() only queues the record, a writer thread appends them to LOG_PATH as json lines in batches of up to
+# LOG_BATCH_SIZE, at least every LOG_FLUSH_INTERVAL_MS. the file is rotated past LOG_MAX_BYTES keeping LOG_BACKUPS old ones.
+# when LOG_QUEUE_SIZE records are waiting, LOG_FULL_POLICY either drops the new one ("drop") or waits for room ("block").
+LOG_PATH = os.getenv("LOG_PATH", os.path.join(PROJECT_DIR, 'logs', 'log.txt'))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", 256))
+LOG_FLUSH_INTERVAL_MS = float(os.getenv("LOG_FLUSH_INTERVAL_MS", 200))
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", 3))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+LOG_FULL_POLICY = os.getenv("LOG_FULL_POLICY", "drop")
+
+# with several workers, each one writes its metrics to METRICS_DIR every METRICS_FLUSH_SECONDS and
+# /metrics adds them all up. unset, /metrics only reports the worker that serves it.
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", 5))
+
+# profiling is off unless one of these is set. PROFILE_SAMPLE_RATE of requests (0 to 1) are profiled, and so is
+# any request with an X-Profile header equal to PROFILE_TOKEN, which also unlocks /monitoring/profiles.
+# stacks are sampled every PROFILE_INTERVAL_MS and kept per route in PROFILE_DIR, at most PROFILE_MAX_STACKS
+# distinct stacks for each of at most PROFILE_MAX_ROUTES routes.
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", 5))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(PROJECT_DIR, 'profiles'))
+PROFILE_MAX_STACKS = int(os.getenv("PROFILE_MAX_STACKS", 2000))
+PROFILE_MAX_ROUTES = int(os.getenv("PROFILE_MAX_ROUTES", 200))
+
+# every query is timed. one slower than SLOW_QUERY_MS goes to the log as "slow-query", and with QUERY_DEBUG on
+# every response carries its query count, total db time and slowest statement as X-DB-* headers.
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 100))
+QUERY_DEBUG = os.getenv("QUERY_DEBUG", "false").lower() == "true"
+
+# routes are admitted per group: at most <limit> requests run at once, up to <queue> more wait for at most
+# <max wait ms>, and the rest get a fast 503 with Retry-After. ADMISSION_LIMITS overrides the defaults as
+# "auth=8:32:2000,db=32:128:2000", and a limit of 0 turns a group's admission control off.
+ADMISSION_LIMITS = os.getenv("ADMISSION_LIMITS", "")
+
+# responses are rendered with orjson. JSON_RESPONSE=json goes back to the stdlib json module, and turns off
+# the direct orm -> json path in serialization.py, so every response goes through its response_model again.
+JSON_RESPONSE = os.getenv("JSON_RESPONSE", "orjson")
+
+# POST /user/bulk takes up to BULK_MAX_ROWS rows, and inserts them BULK_BATCH_SIZE at a time, a transaction each
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", 500))
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", 10000))
+# a json list body is parsed whole, so it's turned down past this many bytes before it's all read
+BULK_MAX_BODY_BYTES = int(os.getenv("BULK_MAX_BODY_BYTES", 16 * 1024 * 1024))
@@ -1,5 +1,4 @@
 from fastapi.routing import APIRouter
-from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse
 from fastapi.requests import Request
 from fastapi import BackgroundTasks
@@ -11,7 +10,17 @@ router = APIRouter(
     tags=['templates']
 )
 
-templates = Jinja2Templates(directory='templates')
+_templates = None
+
+
+def get_templates():
+    # jinja2 is slow to import, so the environment is made on the first render rather than at startup
+    global _templates
+    if _templates is None:
+        from fastapi.templating import Jinja2Templates
+        _templates = Jinja2Templates(directory='templates')
+    return _templates
+
 
 @router.post('/products/{id}', response_class=HTMLResponse)
 def create_new_product(id: str,
@@ -19,7 +28,7 @@ def create_new_product(id: str,
                        product: ProductBase,
                        bt: BackgroundTasks):
     bt.add_task(log_template_call, "creating a new product template")
-    return templates.TemplateResponse(
+    return get_templates().TemplateResponse(
         'product.html',
         {
             'request': request,
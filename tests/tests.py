@@ -1,9 +1,61 @@
+import asyncio
+import atexit
+import json
+import math
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+
+import pytest
+
+# the suite runs on a copy of fastapi-practice.db, so it doesn't change the tracked file and a second run starts
+# from the same rows as the first. set before anything from the app reads settings.py
+TEST_DATABASE_DIR = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, TEST_DATABASE_DIR, True)
+os.environ['DATABASE_PATH'] = os.path.join(TEST_DATABASE_DIR, 'fastapi-practice.db')
+shutil.copy(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fastapi-practice.db'),
+            os.environ['DATABASE_PATH'])
+
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
+from sqlalchemy import delete, inspect, update
 from main import app
+from db import db_user, db_user_async
+from db import hash as hashing
+from db.cache import LRUCache, user_cache
+from admission.limiter import Limiter, limiters
+from chat.hub import Hub
+from jobs.queue import DatabaseStore, JobQueue, MemoryStore, jobs, task
+from logs.logging import LogSink
+from metrics.registry import Histogram
+from db.instrumentation import QueryStatsMiddleware, query_budget
+from serialization import dumps
+from db.schema import init_db
+from db.database import AsyncSessionLocal, SessionLocal, async_engine, engine, set_sqlite_pragmas
+from db.models import DbArticle, DbCatalogVersion, DbJob, DbProduct, DbUser
+from schemas import ArticlePage, UserDisplay, UserPage
 
 
+# the startup hooks don't run without a `with TestClient(app)`, so the schema is set up here
+init_db()
 client = TestClient(app)
 
+
+def auth_headers():
+    auth = client.post(
+        '/token',
+        data={'username': 'authtest', 'password': 'authtest'}
+    )
+    return {'Authorization': 'Bearer ' + auth.json().get('access_token')}
+
+
 def test_get_all_blogs():
     response = client.get('/blog/all')
     assert response.status_code == 200
@@ -55,3 +107,969 @@ def test_post_article():
     assert response.status_code == 200
     assert response.json().get('title') == 'test article'
 
+
+def test_async_get_one_user():
+
+    async def lookup():
+        async with AsyncSessionLocal() as db:
+            user = await db_user_async.get_user_by_username(db, 'authtest')
+            user = await db_user_async.get_one_user(user.id, db)
+        await async_engine.dispose()
+        return user
+
+    user = asyncio.run(lookup())
+    assert user.username == 'authtest'
+    # loaded eagerly, an AsyncSession can't lazy load
+    assert isinstance(user.items, list)
+
+
+def test_lookup_columns_indexed():
+    indexed = {
+        column
+        for table in ('users', 'articles')
+        for index in inspect(engine).get_indexes(table)
+        for column in index['column_names']
+    }
+    assert {'username', 'email', 'user_id'} <= indexed
+
+
+def test_production_pragmas(tmp_path):
+    connection = sqlite3.connect(tmp_path / 'profile.db')
+    set_sqlite_pragmas(connection)
+    assert connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    assert connection.execute('PRAGMA synchronous').fetchone()[0] == 1  # NORMAL
+    connection.close()
+
+
+def test_get_all_users_query_count_is_fixed():
+    headers = auth_headers()
+    # resolves and caches the principal
+    client.get('/user/', headers=headers)
+    with query_budget(2) as before:
+        assert client.get('/user/', headers=headers).status_code == 200
+
+    db = SessionLocal()
+    extra = [DbUser(username=f'nplusone{i}', email='n@n.com', password='x') for i in range(5)]
+    db.add_all(extra)
+    db.flush()
+    db.add_all([DbArticle(title='t', content='c', published=True, user_id=user.id) for user in extra])
+    db.commit()
+    try:
+        with query_budget(2) as after:
+            assert client.get('/user/', headers=headers).status_code == 200
+    finally:
+        for user in extra:
+            db.query(DbArticle).filter(DbArticle.user_id == user.id).delete()
+            db.delete(user)
+        db.commit()
+        db.close()
+
+    # users and one selectin query for every user's articles, however many users
+    assert before.count == after.count == 2
+
+
+def test_get_all_users_pages_with_cursor():
+    headers = auth_headers()
+    first = client.get('/user/', params={'limit': 2}, headers=headers).json()
+    assert len(first['items']) == 2
+    assert first['next_cursor']
+
+    second = client.get('/user/', params={'limit': 2, 'after': first['next_cursor']}, headers=headers).json()
+    first_names = {user['username'] for user in first['items']}
+    assert second['items']
+    assert not first_names & {user['username'] for user in second['items']}
+
+
+def test_get_all_users_invalid_cursor():
+    response = client.get('/user/', params={'after': 'not a cursor'}, headers=auth_headers())
+    assert response.status_code == 400
+
+
+def test_get_all_articles_query_count_is_fixed():
+    headers = auth_headers()
+    client.get('/articles/', headers=headers)
+    # the articles joined to their creators
+    with query_budget(1):
+        response = client.get('/articles/', params={'limit': 100}, headers=headers)
+    assert response.status_code == 200
+    assert response.json()['items']
+
+
+def test_export_users_ndjson():
+    headers = auth_headers()
+    response = client.get('/user/export', params={'batch_size': 2}, headers=headers)
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    users = [json.loads(line) for line in response.text.splitlines()]
+    assert 'authtest' in {user['username'] for user in users}
+    assert all('items' in user for user in users)
+
+
+def test_export_articles_ndjson():
+    response = client.get('/articles/export', headers=auth_headers())
+    assert response.status_code == 200
+    articles = [json.loads(line) for line in response.text.splitlines()]
+    assert articles
+    assert all(article['user']['username'] for article in articles)
+
+
+def test_direct_serialization_matches_response_models():
+    user = DbUser(id=1, username='a', email='a@a.com', password='x')
+    user.items = [DbArticle(id=2, title='t', content='c', published=True, user_id=1)]
+    page = {'items': [user], 'next_cursor': None}
+    assert json.loads(dumps(page, UserPage)) == json.loads(UserPage(items=[UserDisplay.from_orm(user)]).json())
+    # the cache hands back models rather than rows
+    assert json.loads(dumps(UserDisplay.from_orm(user), UserDisplay)) == UserDisplay.from_orm(user).dict()
+    articles = {'items': user.items, 'next_cursor': 'Mg'}
+    assert json.loads(dumps(articles, ArticlePage)) == ArticlePage.parse_obj(
+        {'items': [{'title': 't', 'content': 'c', 'published': True, 'user': {'id': 1, 'username': 'a'}}],
+         'next_cursor': 'Mg'}).dict()
+
+    response = client.get('/user/', headers=auth_headers())
+    assert response.headers['content-type'] == 'application/json'
+    assert UserPage.parse_obj(response.json()).items
+
+
+def test_search_articles():
+    headers = auth_headers()
+    created = client.post(
+        '/articles/',
+        json={'title': 'searchable', 'content': 'a quixotic zebra crossing', 'published': True, 'creator_id': 1},
+        headers=headers
+    )
+    assert created.status_code == 200
+
+    response = client.get('/articles/search', params={'q': 'quixotic zebra'}, headers=headers)
+    assert response.status_code == 200
+    hits = response.json()['items']
+    assert hits[0]['article']['title'] == 'searchable'
+    assert '<b>quixotic</b>' in hits[0]['snippet']
+
+    # deletes reach the index through the triggers
+    db = SessionLocal()
+    db.query(DbArticle).filter(DbArticle.title == 'searchable').delete()
+    db.commit()
+    db.close()
+    response = client.get('/articles/search', params={'q': 'quixotic'}, headers=headers)
+    assert response.json()['items'] == []
+
+
+def test_search_articles_quotes_syntax():
+    response = client.get('/articles/search', params={'q': 'AND "( NEAR'}, headers=auth_headers())
+    assert response.status_code == 200
+
+
+def test_cache_coalesces_concurrent_misses():
+    cache = LRUCache('test', maxsize=10, ttl=60)
+    calls = []
+
+    def load():
+        calls.append(1)
+        time.sleep(0.05)
+        return 'value'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load('key', load))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ['value'] * 8
+    assert len(calls) == 1
+    assert cache.get('key') == (True, 'value')
+
+
+def test_async_cache_load_outlives_a_cancelled_caller():
+    cache = LRUCache('test', maxsize=10, ttl=60)
+    calls = []
+
+    async def load(db):
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'value'
+
+    async def main():
+        first = asyncio.ensure_future(cache.aget_or_load('key', load))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(cache.aget_or_load('key', load))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second, first.cancelled()
+
+    assert asyncio.run(main()) == ('value', True)
+    assert len(calls) == 1
+    assert cache.get('key') == (True, 'value')
+
+
+def test_async_cache_load_survives_the_first_session_closing():
+    username = f'cancel{uuid.uuid4().hex[:8]}'
+    with SessionLocal() as db:
+        user = DbUser(username=username, email='c@x.com', password='x')
+        db.add(user)
+        db.commit()
+        id = user.id
+
+    async def get():
+        async with AsyncSessionLocal() as db:
+            return await db_user_async.get_one_user(id, db)
+
+    async def main():
+        user_cache.invalidate(id)
+        first = asyncio.ensure_future(get())
+        second = asyncio.ensure_future(get())
+        # both are waiting on the load the first one started when it goes away
+        while not user_cache._async_pending:
+            await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    try:
+        assert asyncio.run(main()).username == username
+    finally:
+        with SessionLocal() as db:
+            db.execute(delete(DbUser).where(DbUser.id == id))
+            db.commit()
+        user_cache.invalidate(id)
+
+
+def test_cache_evicts_and_expires():
+    cache = LRUCache('test', maxsize=2, ttl=60)
+    for key in ('a', 'b', 'c'):
+        cache.set(key, key)
+    assert cache.get('a') == (False, None)
+    assert cache.stats()['evictions'] == 1
+
+    cache = LRUCache('test', maxsize=2, ttl=0)
+    cache.set('a', 'a')
+    assert cache.get('a') == (False, None)
+
+
+def test_update_user_invalidates_cache():
+    headers = auth_headers()
+    client.post('/user/', json={'username': 'cached', 'email': 'old@x.com', 'password': 'cached'})
+    user_id = client.post('/token', data={'username': 'cached', 'password': 'cached'}).json()['user_id']
+
+    client.get(f'/user/{user_id}', headers=headers)
+    hits = user_cache.stats()['hits']
+    assert client.get(f'/user/{user_id}', headers=headers).json()['email'] == 'old@x.com'
+    assert user_cache.stats()['hits'] == hits + 1
+
+    client.put(f'/user/{user_id}/update',
+               json={'username': 'cached', 'email': 'new@x.com', 'password': 'cached'},
+               headers=headers)
+    assert client.get(f'/user/{user_id}', headers=headers).json()['email'] == 'new@x.com'
+    client.delete(f'/user/{user_id}/delete', headers=headers)
+    assert client.get(f'/user/{user_id}', headers=headers).status_code == 404
+
+
+def test_login_upgrades_weak_hash():
+    db = SessionLocal()
+    user = DbUser(username='weakhash', email='w@x.com', password=hashing._hash('weakhash', 4))
+    db.add(user)
+    db.commit()
+    try:
+        response = client.post('/token', data={'username': 'weakhash', 'password': 'weakhash'})
+        assert response.status_code == 200
+        db.refresh(user)
+        assert user.password.startswith(f'$2b${hashing.rounds:02d}$')
+        assert not hashing.Hash.needs_update(user.password)
+    finally:
+        db.delete(user)
+        db.commit()
+        db.close()
+
+
+def test_signup_hashes_off_the_threadpool():
+    from router import user
+    # async, they await the hashing pool rather than holding a threadpool thread while it hashes
+    assert asyncio.iscoroutinefunction(user.create_user)
+    assert asyncio.iscoroutinefunction(user.update_username)
+    username = f'offpool{uuid.uuid4().hex[:8]}'
+    response = client.post('/user/', json={'username': username, 'email': 'o@x.com', 'password': 'offpool'})
+    assert response.json() == {'username': username, 'email': 'o@x.com', 'items': []}
+    token = client.post('/token', data={'username': username, 'password': 'offpool'}).json()
+    headers = {'Authorization': 'Bearer ' + token['access_token']}
+    response = client.put(f"/user/{token['user_id']}/update", headers=headers,
+                          json={'username': username, 'email': 'o@x.com', 'password': 'changed'})
+    assert response.status_code == 200
+    assert client.post('/token', data={'username': username, 'password': 'changed'}).status_code == 200
+
+
+def test_bulk_hashing_shares_the_pool(monkeypatch):
+    pool = hashing._get_executor()
+    queued = []
+    peak = []
+
+    class Counting:
+        def submit(self, fn, *args):
+            queued.append(fn)
+            peak.append(len(queued))
+            future = pool.submit(fn, *args)
+            future.add_done_callback(lambda _: queued.pop())
+            return future
+    monkeypatch.setattr(hashing, '_executor', Counting())
+    monkeypatch.setattr(hashing, 'rounds', 4)
+
+    async def two_uploads():
+        return await asyncio.gather(*(hashing.Hash.bcrypt_many_async([name] * 8) for name in 'ab'))
+
+    assert [len(hashes) for hashes in asyncio.run(two_uploads())] == [8, 8]
+    # one chunk per pool process in all, not one each
+    assert max(peak) <= hashing.workers
+
+
+def test_calibrate_stays_in_bounds():
+    current = hashing.rounds
+    try:
+        assert hashing.MIN_ROUNDS <= hashing.Hash.calibrate(target_ms=1) <= hashing.MAX_ROUNDS
+        assert hashing.rounds == hashing.MIN_ROUNDS
+    finally:
+        hashing.set_rounds(current)
+
+
+def test_current_user_is_cached_until_user_changes():
+    client.post('/user/', json={'username': 'principal', 'email': 'p@x.com', 'password': 'principal'})
+    token = client.post('/token', data={'username': 'principal', 'password': 'principal'}).json()
+    headers = {'Authorization': 'Bearer ' + token['access_token']}
+
+    client.get('/articles/1', headers=headers)
+    # article and principal both come from the caches
+    with query_budget(0):
+        response = client.get('/articles/1', headers=headers)
+    assert response.json()['current_user']['username'] == 'principal'
+
+    client.delete(f"/user/{token['user_id']}/delete", headers=headers)
+    assert client.get('/articles/1', headers=headers).status_code == 404
+
+
+def test_refresh_token_rotates():
+    tokens = client.post('/token', data={'username': 'authtest', 'password': 'authtest'}).json()
+    assert tokens['refresh_token']
+
+    refreshed = client.post('/token/refresh', json={'refresh_token': tokens['refresh_token']})
+    assert refreshed.status_code == 200
+    new_tokens = refreshed.json()
+    assert new_tokens['user_name'] == 'authtest'
+    assert new_tokens['refresh_token'] != tokens['refresh_token']
+    headers = {'Authorization': 'Bearer ' + new_tokens['access_token']}
+    assert client.get('/articles/1', headers=headers).status_code == 200
+
+    # reusing the rotated token revokes the whole family
+    assert client.post('/token/refresh', json={'refresh_token': tokens['refresh_token']}).status_code == 401
+    assert client.post('/token/refresh', json={'refresh_token': new_tokens['refresh_token']}).status_code == 401
+
+
+def test_concurrent_refreshes_of_one_token():
+    tokens = client.post('/token', data={'username': 'authtest', 'password': 'authtest'}).json()
+    codes = []
+
+    def refresh():
+        codes.append(client.post('/token/refresh', json={'refresh_token': tokens['refresh_token']}).status_code)
+    threads = [threading.Thread(target=refresh) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(codes) == [200, 401, 401, 401]
+
+
+def test_revoked_refresh_token_is_rejected():
+    tokens = client.post('/token', data={'username': 'authtest', 'password': 'authtest'}).json()
+    assert client.post('/token/revoke', json={'refresh_token': tokens['refresh_token']}).status_code == 200
+    assert client.post('/token/refresh', json={'refresh_token': tokens['refresh_token']}).status_code == 401
+
+
+def test_websocket_broadcast_by_room():
+    with client.websocket_connect('/endpoint') as first, \
+            client.websocket_connect('/endpoint') as second, \
+            client.websocket_connect('/endpoint?room=other') as other:
+        first.send_text('hello')
+        frame = first.receive_json()
+        assert frame['data'] == 'hello'
+        assert second.receive_json() == frame
+        other.send_text('elsewhere')
+        assert other.receive_json()['data'] == 'elsewhere'
+
+
+def test_websocket_replays_missed_messages():
+    with client.websocket_connect('/endpoint?room=replay') as sender:
+        seqs = []
+        for message in ('one', 'two', 'three'):
+            sender.send_text(message)
+            seqs.append(sender.receive_json()['seq'])
+    with client.websocket_connect(f'/endpoint?room=replay&last_seen={seqs[0]}') as resumed:
+        assert [resumed.receive_json()['data'] for _ in range(2)] == ['two', 'three']
+        resumed.send_text('four')
+        assert resumed.receive_json() == {'seq': seqs[-1] + 1, 'data': 'four'}
+
+
+def test_history_keeps_the_newest_frames():
+    from chat.history import History
+
+    history = History(4)
+    for seq in range(1, 11):
+        history.append(seq, str(seq))
+    assert history.since(8) == ['9', '10']
+    # older than the buffer reaches, only what's left
+    assert history.since(2) == ['7', '8', '9', '10']
+    assert history.since(10) == []
+    # a last_seen from before the numbering restarted gets everything
+    history.append(1, '1')
+    assert history.since(10) == ['1']
+
+
+class StalledSocket:
+    def __init__(self):
+        self.closed_with = None
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message):
+        await asyncio.sleep(3600)
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+def test_histories_are_kept_for_a_bounded_number_of_rooms():
+    hub = Hub(history_rooms=2)
+
+    async def run():
+        for room in ('a', 'b', 'c', 'b', 'd'):
+            hub.broadcast(room, 'hello')
+    asyncio.run(run())
+    # a went first, then c as b had a message since
+    assert list(hub.histories) == ['b', 'd']
+
+
+def test_slow_consumer_policies():
+
+    async def flood(policy):
+        hub = Hub(queue_size=2, policy=policy)
+        socket = StalledSocket()
+        connection = await hub.connect(socket, 'room')
+        for i in range(5):
+            hub.broadcast('room', str(i))
+            await asyncio.sleep(0)
+        hub.disconnect(connection)
+        return hub, connection, socket
+
+    hub, connection, _ = asyncio.run(flood('drop_oldest'))
+    # the writer holds '0', the queue keeps the newest two
+    assert [json.loads(connection.queue.get_nowait())['data'] for _ in range(2)] == ['3', '4']
+    assert hub.dropped == 2
+
+    hub, _, socket = asyncio.run(flood('disconnect'))
+    assert hub.slow_disconnects == 1
+    assert socket.closed_with == 1013
+    assert hub.stats()['connections'] == 0
+
+
+def test_unix_pubsub_reaches_every_worker(tmp_path):
+    from chat.pubsub import UnixSocketPubSub
+
+    async def relay():
+        received = {'a': [], 'b': []}
+        path = str(tmp_path / 'chat.sock')
+        workers = {name: UnixSocketPubSub(lambda room, message, seq, name=name: received[name].append((seq, room, message)), path, 1)
+                   for name in received}
+        for worker in workers.values():
+            await worker.start()
+        for _ in range(200):
+            brokers = [worker.broker for worker in workers.values() if worker.broker is not None]
+            if brokers and len(brokers[0].clients) == 2:
+                break
+            await asyncio.sleep(0.01)
+        workers['a'].publish('room', 'first')
+        workers['b'].publish('room', 'second')
+        for _ in range(200):
+            await asyncio.sleep(0.01)
+            if all(len(messages) == 2 for messages in received.values()):
+                break
+        for worker in workers.values():
+            await worker.stop()
+        return received
+
+    received = asyncio.run(relay())
+    # one broker between them, both see the same messages in the same order
+    assert received['a'] == received['b']
+    assert sorted(received['a']) == [(1, 'room', 'first'), (2, 'room', 'second')]
+
+
+def test_unix_pubsub_retries_a_broker_that_fails_to_start(tmp_path, monkeypatch):
+    from chat import pubsub as chat_pubsub
+
+    starts = []
+    start = chat_pubsub.Broker.start
+
+    async def flaky_start(broker):
+        starts.append(broker)
+        if len(starts) == 1:
+            raise OSError('Address already in use')
+        await start(broker)
+    monkeypatch.setattr(chat_pubsub.Broker, 'start', flaky_start)
+    logged = []
+    monkeypatch.setattr(chat_pubsub, 'log', lambda tag, message: logged.append(message))
+
+    async def connect():
+        worker = chat_pubsub.UnixSocketPubSub(lambda room, message, seq: None, str(tmp_path / 'run' / 'chat.sock'), 1)
+        await worker.start()
+        for _ in range(300):
+            if worker.writer is not None:
+                break
+            await asyncio.sleep(0.01)
+        connected = worker.writer is not None
+        await worker.stop()
+        return connected
+
+    assert asyncio.run(connect())
+    assert len(starts) == 2 and len(logged) == 1
+    # the socket's directory is the app's alone
+    assert (tmp_path / 'run').stat().st_mode & 0o777 == 0o700
+
+
+@task('test.add')
+def add_task(a, b):
+    return a + b
+
+
+@task('test.fail')
+def fail_task():
+    raise ValueError('nope')
+
+
+def test_job_status_endpoint():
+    id = jobs.submit('test.add', a=1, b=2)
+    response = client.get(f'/product/jobs/{id}?wait=5')
+    assert response.status_code == 200
+    assert response.json() == {'id': id, 'name': 'test.add', 'status': 'done', 'result': 3, 'error': None}
+    assert client.get('/product/jobs/missing').status_code == 404
+
+
+def test_memory_jobs_drop_the_oldest_finished():
+    store = MemoryStore(keep_finished=2)
+    for id in 'abcd':
+        store.create(id, 'test.add', {})
+    for id in 'abc':
+        store.claim(id)
+        store.update(id, 'done', 1)
+    assert store.get('a') is None
+    assert store.get('b').status == store.get('c').status == 'done'
+    # unfinished jobs are never dropped
+    assert store.get('d').status == 'queued'
+
+
+def test_database_jobs_survive_restart():
+    from db import db_job
+
+    queue = JobQueue(DatabaseStore(), workers=1)
+    failed = queue.submit('test.fail')
+    # a job left queued by a previous run
+    leftover_id = uuid.uuid4().hex
+    with SessionLocal() as db:
+        db_job.create_job(db, leftover_id, 'test.add', {'a': 2, 'b': 2})
+    queue.resume()
+
+    async def results():
+        return await queue.wait(leftover_id, 5), await queue.wait(failed, 5)
+
+    leftover, failed = asyncio.run(results())
+    queue.shutdown()
+    assert (leftover.status, leftover.result) == ('done', 4)
+    assert (failed.status, failed.error) == ('failed', "ValueError('nope')")
+
+
+def test_database_jobs_are_claimed_once():
+    from datetime import datetime, timedelta
+    from db import db_job
+
+    elsewhere, abandoned = uuid.uuid4().hex, uuid.uuid4().hex
+    with SessionLocal() as db:
+        for id in (elsewhere, abandoned):
+            db_job.create_job(db, id, 'test.add', {'a': 1, 'b': 1})
+        # still running on a live worker, and cut off with its lease run out
+        assert db_job.claim_job(db, elsewhere, 'other:1', 60)
+        assert db_job.claim_job(db, abandoned, 'other:2', 60)
+        db.get(DbJob, abandoned).lease_until = datetime.utcnow() - timedelta(seconds=1)
+        db.commit()
+        # a second claim of a live job fails
+        assert not db_job.claim_job(db, elsewhere, 'other:3', 60)
+
+    queue = JobQueue(DatabaseStore(), workers=1)
+    queue.resume()
+    asyncio.run(queue.wait(abandoned, 5))
+    queue.shutdown()
+    with SessionLocal() as db:
+        assert db.get(DbJob, elsewhere).status == 'running'
+        assert db.get(DbJob, abandoned).status == 'done'
+
+
+def test_product_catalog_is_shared_and_cached():
+    from db import db_product
+
+    names = client.get('/product/withheader/').json()
+    assert names[:3] == ['watch', 'camera', 'phone']
+    with SessionLocal() as db:
+        last_id = db.query(DbProduct.id).order_by(DbProduct.id.desc()).first()[0]
+    # the old bounds check let id == len(products) through to an IndexError
+    assert client.get(f'/product/{last_id + 1}').status_code == 404
+    assert "'watch'" in client.get('/product/1').text
+
+    # another worker adding a product: only the version in the database tells this one
+    tripod, lens = f'tripod-{uuid.uuid4().hex[:8]}', f'lens-{uuid.uuid4().hex[:8]}'
+    with SessionLocal() as db:
+        db.add(DbProduct(name=tripod))
+        db.execute(update(DbCatalogVersion).values(version=DbCatalogVersion.version + 1))
+        db.commit()
+    # until it's due to check again
+    db_product._checked_at = time.monotonic()
+    assert tripod not in client.get('/product/withheader/').json()
+    db_product._checked_at = 0
+    assert client.get('/product/withheader/').json()[-1] == tripod
+
+    response = client.post('/product/new', data={'name': lens})
+    assert response.json()[-1] == lens
+
+
+def test_log_sink_batches_and_rotates(tmp_path):
+    path = str(tmp_path / 'log.txt')
+    sink = LogSink(path, max_bytes=200, backups=2)
+    for i in range(20):
+        sink.emit({'tag': 'test', 'message': str(i)})
+    sink.close()
+    assert sink.stats()['written'] == 20
+    assert sink.rotations >= 1
+    files = [path + '.2', path + '.1', path]
+    assert not os.path.exists(path + '.3')
+    lines = [json.loads(line) for name in files if os.path.exists(name) for line in open(name)]
+    # the oldest rotated file is gone, what's left is the newest records in order
+    assert [record['message'] for record in lines] == [str(i) for i in range(20 - len(lines), 20)]
+
+
+def test_log_sinks_share_a_file(tmp_path):
+    # one sink per worker, all on the same file
+    path = str(tmp_path / 'log.txt')
+    sinks = [LogSink(path, max_bytes=2000, backups=100, batch_size=8) for _ in range(2)]
+    for i in range(300):
+        for number, sink in enumerate(sinks):
+            sink.emit({'message': f'{number}-{i}'})
+    for sink in sinks:
+        sink.close()
+    names = [name for name in os.listdir(tmp_path) if not name.endswith('.lock')]
+    assert len(names) > 2
+    # a file is only rotated once it's full, never again by the other worker straight after
+    assert all(os.path.getsize(tmp_path / name) >= 2000 for name in names if name != 'log.txt')
+    # every line whole, none lost
+    messages = [json.loads(line)['message'] for name in names for line in open(tmp_path / name)]
+    assert sorted(messages) == sorted(f'{number}-{i}' for number in range(2) for i in range(300))
+
+
+def test_log_sink_rotates_without_fcntl(tmp_path, monkeypatch):
+    # as on windows
+    monkeypatch.setitem(sys.modules, 'fcntl', None)
+    path = str(tmp_path / 'log.txt')
+    sink = LogSink(path, max_bytes=200, backups=2)
+    for i in range(20):
+        sink.emit({'message': str(i)})
+    sink.close()
+    assert sink.rotations >= 1
+    assert not os.path.exists(path + '.lock')
+
+
+def test_log_sink_drops_when_full(tmp_path):
+    sink = LogSink(str(tmp_path / 'log.txt'), queue_size=2)
+    # no writer draining the queue
+    sink.writer = threading.current_thread()
+    for i in range(5):
+        sink.emit({'message': str(i)})
+    assert sink.dropped == 3
+    assert sink.queue.qsize() == 2
+
+
+def test_metrics_by_route_template():
+    client.get('/product/1')
+    client.get('/product/2')
+    client.get('/no/such/path')
+    text = client.get('/metrics').text
+    assert 'http_requests_total{route="/product/{id}",method="GET",status="200"} ' in text
+    assert 'route="unmatched",method="GET",status="404"' in text
+    assert 'http_request_duration_seconds_bucket{route="/product/{id}",method="GET",le="+Inf"}' in text
+    assert 'db_pool_checkout_seconds_count{engine="write"}' in text
+    assert 'threadpool_threads_total 40' in text
+
+
+def test_metrics_merge_across_workers():
+    from metrics.registry import merge
+
+    def worker(pid, count, buckets, in_flight):
+        return {'pid': pid, 'metrics': {
+            'http_requests_total': [[['/x', 'GET', '200'], count]],
+            'http_request_duration_seconds': [[['/x', 'GET'], buckets]],
+            'http_requests_in_flight': [[[], in_flight]],
+        }}
+
+    size = len(Histogram('h', 'h').buckets) + 2
+    live = worker(os.getpid(), 2, [1] + [0] * (size - 2) + [0.001], 1)
+    # a pid that can't be running
+    dead = worker(2 ** 22 + 1, 3, [0, 2] + [0] * (size - 3) + [0.02], 5)
+    merged = merge([live, dead])
+    assert merged['http_requests_total'][('/x', 'GET', '200')] == 5
+    assert merged['http_request_duration_seconds'][('/x', 'GET')][:2] == [1, 2]
+    assert merged['http_requests_in_flight'][()] == 1
+
+
+def test_dead_workers_metrics_are_folded_into_one_file(tmp_path, monkeypatch):
+    from metrics import registry as metrics
+
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmp_path))
+    monkeypatch.setattr(metrics, '_writing_for', None)
+
+    def requests(total):
+        return {'http_requests_total': [[['/gone', 'GET', '200'], total]], 'http_requests_in_flight': [[[], 4]]}
+
+    def total():
+        merged = metrics.merge(metrics.read_snapshots())
+        return merged['http_requests_total'].get(('/gone', 'GET', '200'), 0), merged['http_requests_in_flight']
+
+    # a worker this one has the pid of now, and two that are gone
+    metrics.dump_snapshot(metrics.snapshot_path(os.getpid()), {'pid': os.getpid(), 'metrics': requests(7)})
+    for pid, count in ((2 ** 22 + 1, 2), (2 ** 22 + 2, 3)):
+        metrics.dump_snapshot(metrics.snapshot_path(pid), {'pid': pid, 'metrics': requests(count)})
+    assert total()[0] == 12
+    assert sorted(name for name in os.listdir(tmp_path) if name.endswith('.json')) == [
+        f'{os.getpid()}.json', 'retired.json']
+    # their gauges are gone with them, and the totals never go backwards
+    assert total()[1].get((), 0) < 4
+    metrics.dump_snapshot(metrics.snapshot_path(2 ** 22 + 3), {'pid': 2 ** 22 + 3, 'metrics': requests(1)})
+    assert total()[0] == 13
+
+
+def test_profiler_samples_flagged_requests(tmp_path):
+    from fastapi import FastAPI
+    from metrics.profiler import ProfileStore, ProfilerMiddleware, Sampler
+
+    profiled = FastAPI()
+
+    @profiled.get('/busy/{id}')
+    def busy_handler(id: int):
+        end = time.perf_counter() + 0.1
+        while time.perf_counter() < end:
+            pass
+
+    store = ProfileStore(str(tmp_path))
+    wrapped = TestClient(ProfilerMiddleware(profiled, sample_rate=0, token='secret', sampler=Sampler(1), store=store))
+    wrapped.get('/busy/1')
+    wrapped.get('/busy/2', headers={'X-Profile': 'wrong'})
+    assert store.routes() == {}
+    wrapped.get('/busy/3', headers={'X-Profile': 'secret'})
+    assert list(store.routes()) == ['GET /busy/{id}']
+    assert 'busy_handler' in store.folded('GET /busy/{id}')
+    # the admin endpoints don't exist without PROFILE_TOKEN
+    assert client.get('/monitoring/profiles').status_code == 404
+
+
+def test_profile_store_skips_torn_lines(tmp_path):
+    from metrics.profiler import ProfileStore
+
+    store = ProfileStore(str(tmp_path), max_routes=2)
+    with open(store.path('GET /a'), 'w') as file:
+        file.write('a;b 2\na;b;c 1\na;b;c 1a;b\n')
+    # another worker's temp file doesn't count as a route
+    (tmp_path / 'GET%20%2Fx.folded.123.tmp').write_text('x 1\n')
+    store.add('GET /a', Counter({'a;b': 1}))
+    store.add('GET /b', Counter({'a': 1}))
+    assert store.read('GET /a') == Counter({'a;b': 3, 'a;b;c': 1})
+    assert store.routes() == {'GET /a': 4, 'GET /b': 1}
+
+
+def test_update_user_query_budget():
+    client.post('/user/', json={'username': 'budget', 'email': 'b@x.com', 'password': 'budget'})
+    token = client.post('/token', data={'username': 'budget', 'password': 'budget'}).json()
+    headers = {'Authorization': 'Bearer ' + token['access_token']}
+    client.get('/articles/1', headers=headers)
+    # the user with its articles, the user update and revoking the refresh tokens
+    with query_budget(4):
+        response = client.put(f"/user/{token['user_id']}/update", headers=headers,
+                              json={'username': 'budget', 'email': 'new@x.com', 'password': 'budget'})
+    assert response.json() == {'username': 'budget', 'email': 'new@x.com', 'items': []}
+
+
+def test_query_debug_headers():
+    debug = TestClient(QueryStatsMiddleware(app, headers=True))
+    response = debug.get('/articles/search', params={'q': 'end'}, headers=auth_headers())
+    assert int(response.headers['x-db-query-count']) >= 1
+    assert float(response.headers['x-db-time-ms']) >= 0
+    assert 'SELECT' in response.headers['x-db-slowest']
+    assert 'x-db-query-count' not in client.get('/blog/all').headers
+
+
+def test_admission_queues_then_sheds():
+
+    async def burst():
+        limiter = Limiter('test', limit=1, queue_size=1, max_wait_ms=200)
+        await limiter.acquire()
+        queued = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        # the queue is full, turned away without waiting
+        with pytest.raises(HTTPException) as full:
+            await limiter.acquire()
+        limiter.release(0.01)
+        await queued
+        assert limiter.active == 1
+        # still held, the next one waits out max_wait and gives up
+        start = time.perf_counter()
+        with pytest.raises(HTTPException) as timed_out:
+            await limiter.acquire()
+        assert time.perf_counter() - start >= 0.2
+        limiter.release(0.01)
+        assert (limiter.active, len(limiter.waiters)) == (0, 0)
+        return full.value, timed_out.value
+
+    for error in asyncio.run(burst()):
+        assert error.status_code == 503
+        assert int(error.headers['Retry-After']) >= 1
+
+
+def test_busy_auth_routes_fail_fast():
+    auth = limiters['auth']
+    active, service_time = auth.active, auth.service_time
+    # every slot taken by logins that take far longer than anyone should wait
+    auth.active, auth.service_time = auth.limit, 60
+    try:
+        response = client.post('/token', data={'username': 'authtest', 'password': 'authtest'})
+        assert response.status_code == 503
+        assert int(response.headers['Retry-After']) == math.ceil(60 / auth.limit)
+        # other groups carry on
+        assert client.get('/blog/all').status_code == 200
+    finally:
+        auth.active, auth.service_time = active, service_time
+
+
+def test_import_time_budget():
+    # -X importtime prints "import time: self [us] | cumulative | name" for every module
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'],
+                            capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, total, name = line.split('|')
+            if total.strip().isdigit():
+                cumulative[name.strip()] = int(total)
+    # only needed on first use, or not by the app at all
+    for deferred in ('uvicorn', 'jinja2', 'passlib'):
+        assert deferred not in cumulative
+    # generous, it's ~0.7s on a laptop, most of it fastapi and sqlalchemy
+    assert cumulative['main'] < 3_000_000
+
+
+def test_unique_username_index_waits_for_duplicates(tmp_path):
+    from sqlalchemy import create_engine
+    from db.database import Base, create_missing_indexes
+
+    old = create_engine(f'sqlite:///{tmp_path / "old.db"}')
+    Base.metadata.create_all(bind=old)
+    with old.begin() as connection:
+        # as the username index was before it was unique, with the duplicates that allowed
+        connection.exec_driver_sql('DROP INDEX ix_users_username')
+        connection.exec_driver_sql('CREATE INDEX ix_users_username ON users (username)')
+        connection.exec_driver_sql("INSERT INTO users (username) VALUES ('twice'), ('twice')")
+    create_missing_indexes(old)
+
+    def unique():
+        return {index['name']: index['unique'] for index in inspect(old).get_indexes('users')}['ix_users_username']
+    assert not unique()
+
+    with old.begin() as connection:
+        connection.exec_driver_sql("DELETE FROM users WHERE id = 2")
+    create_missing_indexes(old)
+    assert unique()
+
+
+def test_bulk_create_users():
+    rows = [
+        {'username': 'bulk1', 'email': 'bulk1@bulk.com', 'password': 'bulk1'},
+        {'username': 'bulk2'},
+        {'username': 'authtest', 'email': 'a@a.com', 'password': 'x'},
+        {'username': 'bulk1', 'email': 'again@bulk.com', 'password': 'x'},
+    ]
+    assert client.post('/user/bulk', json=rows).status_code == 401
+    headers = auth_headers()
+    response = client.post('/user/bulk', json=rows, headers=headers)
+    assert response.status_code == 200
+    report = response.json()
+    assert (report['created'], report['failed']) == (1, 3)
+    created, missing, taken, twice = report['results']
+    assert 'email' in missing['error'] and 'taken' in taken['error'] and 'taken' in twice['error']
+    with SessionLocal() as db:
+        assert db.get(DbUser, created['id']).username == 'bulk1'
+    assert client.post('/token', data={'username': 'bulk1', 'password': 'bulk1'}).status_code == 200
+
+    # ndjson, read line by line
+    body = b'{"username": "bulk3", "email": "bulk3@bulk.com", "password": "x"}\n\nnot json\n'
+    report = client.post('/user/bulk', content=body,
+                         headers=dict(headers, **{'Content-Type': 'application/x-ndjson'})).json()
+    assert [result['index'] for result in report['results']] == [0, 1]
+    assert report['results'][0]['id'] and 'Invalid json' in report['results'][1]['error']
+
+    assert client.post('/user/bulk', json={'username': 'x'}, headers=headers).status_code == 400
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr('router.bulk.BULK_MAX_ROWS', 1)
+        assert client.post('/user/bulk', json=rows[:2], headers=headers).status_code == 413
+        endless = b''.join(b'{}\n' for _ in range(3))
+        response = client.post('/user/bulk', content=endless,
+                               headers=dict(headers, **{'Content-Type': 'application/x-ndjson'}))
+        assert response.status_code == 413
+        # a json body is turned down on its size too, whether or not it says how long it is
+        patch.setattr('router.bulk.BULK_MAX_BODY_BYTES', 10)
+        assert client.post('/user/bulk', json=[{'username': 'too long'}], headers=headers).status_code == 413
+        chunked = client.post('/user/bulk', content=iter([b'[{"username": ', b'"too long"}]']), headers=headers)
+        assert chunked.status_code == 413
+
+
+def test_bulk_create_users_race():
+    rows = [{'username': 'racedup', 'email': 'race@bulk.com', 'password': 'x'}]
+    headers = auth_headers()
+    reports = []
+    threads = [threading.Thread(target=lambda: reports.append(client.post('/user/bulk', json=rows,
+                                                                          headers=headers).json()))
+               for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(report['created'] for report in reports) == [0, 1]
+    with SessionLocal() as db:
+        assert db.query(DbUser).filter(DbUser.username == 'racedup').count() == 1
+        # a clash in the executemany falls back to one row at a time, only the clashing row fails
+        row = {'username': 'racedup2', 'email': 'r@r.com', 'password': 'x'}
+        first, second = db_user.create_users(db, [row, dict(row)])
+        assert first and second is None
+
+
+def test_import_articles_ndjson():
+    auth = client.post('/token', data={'username': 'authtest', 'password': 'authtest'}).json()
+    headers = {'Authorization': 'Bearer ' + auth['access_token'], 'Content-Type': 'application/x-ndjson'}
+    article = {'title': 'imported', 'content': 'imported', 'published': True, 'creator_id': auth['user_id']}
+    lines = [
+        json.dumps(article),
+        json.dumps(dict(article, content='write to me@example.com')),
+        '',
+        '{not json',
+        json.dumps(dict(article, creator_id=10 ** 9)),
+        json.dumps(article),
+    ]
+    with SessionLocal() as db:
+        before = db.query(DbArticle).filter(DbArticle.title == 'imported').count()
+    response = client.post('/articles/import', params={'batch_size': 2}, headers=headers,
+                           content='\n'.join(lines).encode())
+    assert response.status_code == 200
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert {result['line'] for result in results if 'error' in result} == {2, 4, 5}
+    assert results[-1] == {'line': 6, 'created': 2, 'failed': 3, 'done': True}
+    # progress after each batch of 2
+    assert [result['line'] for result in results if 'created' in result] == [5, 6]
+    with SessionLocal() as db:
+        assert db.query(DbArticle).filter(DbArticle.title == 'imported').count() == before + 2